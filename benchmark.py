@@ -0,0 +1,607 @@
+"""
+This module benchmarks the export, calculation, forecast and workbook stages against a local SQLite stand-in
+for the warehouse, so performance can be measured without production database access.
+
+It generates synthetic TableOne-TableFive data at a configurable scale, runs each stage with the stand-in
+injected in place of the warehouse connection and configuration, and records the wall time and the peak
+memory of every stage to a JSON file. A later run can be compared against that file as a baseline.
+
+Usage:
+------
+python benchmark.py --rows 100000 --output bench_100k.json
+python benchmark.py --rows 100000 --baseline bench_100k.json --stages get_data,metric_calculator
+
+Functions:
+----------
+generate_data(engine, rows, seed=0): fills a SQLite database with synthetic tables of about rows rows each
+load_module(path, namespace): loads a pipeline module with the stand-in injected for its warehouse imports
+build_stages(engine, dims, workdir): builds the stage functions to benchmark
+run_benchmark(rows, db_path, stages=None, measure_memory=True): generates the data and times every stage
+compare_to_baseline(results, baseline, threshold=1.2): reports the stages that got slower than the baseline
+
+Module imports:
+---------------
+sqlalchemy, pandas, numpy, openpyxl: the same dependencies as the pipeline modules
+"""
+
+import argparse
+import ast
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+import sqlalchemy as sa
+from sqlalchemy import Float, and_, case, cast, func, select
+from sqlalchemy.orm import declarative_base, sessionmaker
+from sqlalchemy.sql import label
+
+package_dir = os.path.dirname(os.path.abspath(__file__))
+
+# Imports that point at the warehouse, its configuration, the shared connection pool or the warehouse tables.
+# The benchmark injects SQLite-backed stand-ins for these names instead.
+replaced_imports = ('utils', 'src', 'connection_pool', 'data_extract_common_table_expressions')
+
+Base = declarative_base()
+
+# data_pull: rates, facts and categories
+class PullRates(Base):
+    __tablename__ = 'pull_rates'
+    id = sa.Column(sa.Integer, primary_key=True)
+    time = sa.Column(sa.String, index=True)
+    input_attr = sa.Column(sa.String)
+    output_attr = sa.Column(sa.String)
+    rate = sa.Column(sa.Float)
+    rate_type = sa.Column(sa.String)
+
+class PullFacts(Base):
+    __tablename__ = 'pull_facts'
+    id = sa.Column(sa.Integer, primary_key=True)
+    category = sa.Column(sa.String, index=True)
+    attribute = sa.Column(sa.String)
+    time = sa.Column(sa.String, index=True)
+    measure1 = sa.Column(sa.Float)
+    measure2 = sa.Column(sa.Float)
+    measure3 = sa.Column(sa.Float)
+    measure4 = sa.Column(sa.Float)
+    measure5 = sa.Column(sa.Float)
+    measure6 = sa.Column(sa.Float)
+    update_time = sa.Column(sa.DateTime)
+
+class PullCategories(Base):
+    __tablename__ = 'pull_categories'
+    category = sa.Column(sa.String, primary_key=True)
+    region = sa.Column(sa.String)
+
+# data_export: subscriptions and revenue, countries and exchange rates
+class MarketFacts(Base):
+    __tablename__ = 'market_facts'
+    id = sa.Column(sa.Integer, primary_key=True)
+    time = sa.Column(sa.String, index=True)
+    territory = sa.Column(sa.String, index=True)
+    company = sa.Column(sa.String)
+    business_line = sa.Column(sa.String)
+    subscriptions = sa.Column(sa.Float)
+    revenue = sa.Column(sa.Float)
+    currency = sa.Column(sa.String)
+    forecast_flag = sa.Column(sa.String)
+    update_time = sa.Column(sa.DateTime)
+
+class MarketCountries(Base):
+    __tablename__ = 'market_countries'
+    country = sa.Column(sa.String, primary_key=True)
+    region = sa.Column(sa.String)
+
+class MarketRates(Base):
+    __tablename__ = 'market_rates'
+    id = sa.Column(sa.Integer, primary_key=True)
+    time = sa.Column(sa.String, index=True)
+    input_currency = sa.Column(sa.String)
+    output_currency = sa.Column(sa.String)
+    exchange_rate = sa.Column(sa.Float)
+    exchange_rate_type = sa.Column(sa.String)
+
+# get_data and extract_user_data: survey respondents, periods, countries, usage and the wide survey table
+class SurveyRespondents(Base):
+    __tablename__ = 'survey_respondents'
+    id = sa.Column(sa.Integer, primary_key=True)
+    time_pk = sa.Column(sa.Integer, index=True)
+    respondent_pk = sa.Column(sa.Integer, index=True)
+    country = sa.Column(sa.String)
+
+class SurveyTimes(Base):
+    __tablename__ = 'survey_times'
+    pk = sa.Column(sa.Integer, primary_key=True)
+    time = sa.Column(sa.String)
+
+class SurveyCountries(Base):
+    __tablename__ = 'survey_countries'
+    country = sa.Column(sa.String, primary_key=True)
+    region = sa.Column(sa.String)
+
+class SurveyUsage(Base):
+    __tablename__ = 'survey_usage'
+    id = sa.Column(sa.Integer, primary_key=True)
+    time_pk = sa.Column(sa.Integer, index=True)
+    respondent_pk = sa.Column(sa.Integer, index=True)
+    online_service = sa.Column(sa.String)
+    service_type_field = sa.Column(sa.String)
+    used_in_month = sa.Column(sa.String)
+
+class SurveyResponses(Base):
+    __tablename__ = 'survey_responses'
+    id = sa.Column(sa.Integer, primary_key=True)
+    time = sa.Column(sa.String, index=True)
+    area = sa.Column(sa.String)
+    region = sa.Column(sa.String)
+    respondent_pk = sa.Column(sa.Integer)
+    service_1 = sa.Column(sa.Float)
+    service_2 = sa.Column(sa.Float)
+    service_3 = sa.Column(sa.Float)
+    service_4 = sa.Column(sa.Float)
+    service_5 = sa.Column(sa.Float)
+    other_services = sa.Column(sa.Float)
+
+service_columns = ['service_1', 'service_2', 'service_3', 'service_4', 'service_5', 'other_services']
+
+def _dimensions(rows, n_times=20, n_regions=10):
+    """
+    Splits a row count into times, territories and rows per (time, territory).
+    """
+    n_territories = int(max(2, min(250, (rows / n_times) ** 0.5 / 2)))
+    per_group = max(1, rows // (n_times * n_territories))
+    start = pd.Period('2019Q1', freq='Q')
+    times = [str(start + i) for i in range(n_times)]
+    territories = [f"T{i:03d}" for i in range(n_territories)]
+    regions = [f"Region_{i:02d}" for i in range(min(n_regions, n_territories))]
+    return {
+        'rows': rows,
+        'times': times,
+        'territories': territories,
+        'regions': regions,
+        'region_of': {territory: regions[i % len(regions)] for i, territory in enumerate(territories)},
+        'per_group': per_group
+    }
+
+def _insert(engine, table, frames):
+    """
+    Inserts the frames produced by a generator, so only one batch is held in memory at a time.
+    """
+    for frame in frames:
+        frame.to_sql(table.__tablename__, engine, if_exists='append', index=False, chunksize=50000)
+
+def _batches(total, batch_size=200000):
+    for start in range(0, total, batch_size):
+        yield start, min(batch_size, total - start)
+
+def generate_data(engine, rows, seed=0):
+    """
+    Fills a SQLite database with synthetic tables of about rows rows each.
+
+    Parameters:
+    - engine (SQLAlchemy Engine): The SQLite database.
+    - rows (int): The approximate number of rows of each fact table, e.g. 10_000 to 100_000_000.
+    - seed (int): The seed of the random generator.
+
+    Returns:
+    - dims (dict): The times, territories, regions and group sizes of the generated data.
+    """
+    rng = np.random.default_rng(seed)
+    dims = _dimensions(rows)
+    times, territories, region_of = dims['times'], dims['territories'], dims['region_of']
+    n_times, n_territories, per_group = len(times), len(territories), dims['per_group']
+    update_time = pd.Timestamp('2024-01-01')
+
+    Base.metadata.drop_all(engine)
+    Base.metadata.create_all(engine)
+    print(f"Generating about {rows:,} rows per fact table "
+          f"({n_times} times x {n_territories} territories x {per_group} rows)...")
+
+    # Dimension tables
+    currencies = [f"C{i % 20:02d}" for i in range(n_territories)]
+    pd.DataFrame({'country': territories, 'region': [region_of[t] for t in territories]}).to_sql(
+        MarketCountries.__tablename__, engine, if_exists='append', index=False)
+    pd.DataFrame({'country': territories, 'region': [region_of[t] for t in territories]}).to_sql(
+        SurveyCountries.__tablename__, engine, if_exists='append', index=False)
+    pd.DataFrame({'category': territories, 'region': [region_of[t] for t in territories]}).to_sql(
+        PullCategories.__tablename__, engine, if_exists='append', index=False)
+    pd.DataFrame({'pk': np.arange(1, n_times + 1), 'time': times}).to_sql(
+        SurveyTimes.__tablename__, engine, if_exists='append', index=False)
+
+    rate_keys = pd.MultiIndex.from_product([times, sorted(set(currencies)), ['Fixed', 'Floating']],
+                                           names=['time', 'input_currency', 'exchange_rate_type']).to_frame(index=False)
+    rate_keys['output_currency'] = 'USD'
+    rate_keys['exchange_rate'] = rng.uniform(0.5, 150, len(rate_keys))
+    rate_keys.to_sql(MarketRates.__tablename__, engine, if_exists='append', index=False)
+    rate_keys.rename(columns={'input_currency': 'input_attr', 'output_currency': 'output_attr',
+                              'exchange_rate': 'rate', 'exchange_rate_type': 'rate_type'}).to_sql(
+        PullRates.__tablename__, engine, if_exists='append', index=False)
+
+    total = n_times * n_territories * per_group
+
+    def market_frames():
+        for start, size in _batches(total):
+            position = np.arange(start, start + size)
+            territory = position // per_group % n_territories
+            yield pd.DataFrame({
+                'time': np.array(times)[position // (per_group * n_territories)],
+                'territory': np.array(territories)[territory],
+                'company': [f"Company_{i}" for i in position % per_group],
+                'business_line': 'Business Line',
+                'subscriptions': rng.integers(1, 100000, size).astype(float),
+                'revenue': rng.uniform(1e3, 1e7, size),
+                'currency': np.array(currencies)[territory],
+                'forecast_flag': 'A',
+                'update_time': update_time
+            })
+
+    def pull_frames():
+        for start, size in _batches(total):
+            position = np.arange(start, start + size)
+            territory = position // per_group % n_territories
+            measures = rng.uniform(1, 1000, (size, 6))
+            frame = pd.DataFrame({
+                'category': np.array(territories)[territory],
+                'attribute': np.array(currencies)[territory],
+                'time': np.array(times)[position // (per_group * n_territories)],
+                'update_time': update_time
+            })
+            for i in range(6):
+                frame[f"measure{i + 1}"] = measures[:, i]
+            yield frame
+
+    # About four usage rows per respondent, so the respondent tables are a quarter of the row count
+    respondents = max(n_times * n_territories, total // 4)
+
+    def respondent_frames():
+        for start, size in _batches(respondents):
+            position = np.arange(start, start + size)
+            yield pd.DataFrame({
+                'time_pk': position % n_times + 1,
+                'respondent_pk': position + 1,
+                'country': np.array(territories)[position // n_times % n_territories]
+            })
+
+    def usage_frames():
+        for start, size in _batches(respondents):
+            position = np.repeat(np.arange(start, start + size), 4)
+            yield pd.DataFrame({
+                'time_pk': position % n_times + 1,
+                'respondent_pk': position + 1,
+                'online_service': np.tile([f"Service {i}" for i in range(1, 5)], size),
+                'service_type_field': rng.choice([f"Type{i}" for i in range(1, 8)], size * 4),
+                'used_in_month': rng.choice(['Yes', 'No'], size * 4)
+            })
+
+    def response_frames():
+        for start, size in _batches(respondents):
+            position = np.arange(start, start + size)
+            time_index = position % n_times
+            territory = np.array(territories)[position // n_times % n_territories]
+            # Adoption grows along a logistic curve over the periods
+            adoption = 0.8 / (1 + np.exp(-0.4 * (time_index - n_times / 2)))
+            frame = pd.DataFrame({
+                'time': np.array(times)[time_index],
+                'area': 'Area',
+                'region': [region_of[t] for t in territory],
+                'respondent_pk': position + 1
+            })
+            for i, column in enumerate(service_columns):
+                frame[column] = (rng.random(size) < adoption / (i + 1)).astype(float)
+            yield frame
+
+    _insert(engine, MarketFacts, market_frames())
+    _insert(engine, PullFacts, pull_frames())
+    _insert(engine, SurveyRespondents, respondent_frames())
+    _insert(engine, SurveyUsage, usage_frames())
+    _insert(engine, SurveyResponses, response_frames())
+    return dims
+
+def convert_quarter_to_datetime(time):
+    """
+    Stand-in for utils.functions.convert_quarter_to_datetime: '2023Q4' is the last day of the quarter.
+    """
+    return pd.Period(time, freq='Q').end_time.normalize()
+
+def clean_timestamps(data_df):
+    """
+    Stand-in for the warehouse clean_timestamps: adds date, year and quarter as the last three columns.
+    """
+    data_df['date'] = pd.PeriodIndex(data_df['time'], freq='Q').end_time.normalize()
+    data_df['year'] = data_df['date'].dt.year
+    data_df['quarter'] = data_df['date'].dt.quarter
+    return data_df
+
+def load_module(path, namespace):
+    """
+    Loads a pipeline module with the stand-in injected for its warehouse imports.
+
+    Imports from utils, src, connection_pool and data_extract_common_table_expressions are skipped, since
+    the stand-in provides those names in namespace, and so are top-level expression statements such as a main() call.
+
+    Parameters:
+    - path (str): The path of the module.
+    - namespace (dict): The stand-in names, e.g. TableOne, establish_connection and time_range.
+
+    Returns:
+    - module (dict): The namespace of the loaded module.
+    """
+    with open(path) as f:
+        tree = ast.parse(f.read(), filename=path)
+
+    body = []
+    for node in tree.body:
+        if isinstance(node, ast.ImportFrom) and (node.level > 0 or (node.module or '').split('.')[0] in replaced_imports):
+            continue
+        if isinstance(node, ast.Expr) and not isinstance(node.value, ast.Constant):
+            continue
+        if isinstance(node, ast.If) and 'main' in ast.unparse(node.test):
+            continue
+        body.append(node)
+    tree.body = body
+
+    module = dict(namespace)
+    module['__name__'] = os.path.splitext(os.path.basename(path))[0] + '_benchmark'
+    exec(compile(tree, path, 'exec'), module)
+    return module
+
+def _stand_in(engine, dims):
+    """
+    Builds the names that the pipeline modules expect from the warehouse and its configuration.
+    """
+    session_factory = sessionmaker(bind=engine)
+    data_dates = [convert_quarter_to_datetime(t) for t in dims['times']]
+    horizon = pd.date_range(data_dates[-1] + pd.offsets.QuarterEnd(1), periods=12, freq='Q')
+
+    def create_date_range():
+        return list(horizon), list((horizon - data_dates[0]).days)
+
+    return {
+        'pd': pd, 'np': np, 'select': select, 'func': func, 'and_': and_, 'case': case, 'cast': cast,
+        'Float': Float, 'label': label,
+        'establish_connection': session_factory,
+        'pooled_session': session_factory,
+        'clean_timestamps': clean_timestamps,
+        'convert_quarter_to_datetime': convert_quarter_to_datetime,
+        'convert_period_to_datetime': convert_quarter_to_datetime,
+        'create_date_range': create_date_range,
+        'time_range': dims['times'],
+        'countries': dims['territories'],
+        'categories': dims['territories']
+    }
+
+def _master_table(dims, companies=50, seed=0):
+    """
+    Builds a synthetic master_table with three subcategories per company.
+    """
+    rng = np.random.default_rng(seed)
+    n = companies * 3
+    return pd.DataFrame({
+        'company': [f"Company_{i // 3}" for i in range(n)],
+        'service_type': [f"Service_{i % 3}" for i in range(n)],
+        'channel_type': [None if i % 2 else 'Online' for i in range(n)],
+        'index_time': rng.choice(dims['times'], n),
+        'base_territory': rng.choice(dims['territories'], n),
+        'base_currency': 'USD',
+        'index_metric': rng.uniform(1, 100, n)
+    })
+
+def build_stages(engine, dims, workdir):
+    """
+    Builds the stage functions to benchmark, in pipeline order.
+
+    Parameters:
+    - engine (SQLAlchemy Engine): The SQLite stand-in with the generated data.
+    - dims (dict): The output of generate_data.
+    - workdir (str): A directory for the workbook written by the workbook_update stage.
+
+    Returns:
+    - stages (dict): A function without arguments for each stage name.
+    """
+    stand_in = _stand_in(engine, dims)
+    path = lambda name: os.path.join(package_dir, name)
+
+    data_pull = load_module(path('data_pull.py'), dict(
+        stand_in, TableOne=PullRates, TableTwo=PullFacts, TableThree=PullCategories))
+    data_export = load_module(path('data_export.py'), dict(
+        stand_in, TableOne=MarketFacts, TableTwo=MarketCountries, TableThree=MarketRates))
+    cte = load_module(path('data_extract_common_table_expressions.py'), dict(
+        stand_in, TableOne=SurveyRespondents, TableTwo=SurveyTimes, TableThree=SurveyCountries,
+        TableFour=SurveyUsage, TableFive=SurveyResponses))
+
+    def survey_export():
+        data_df = pd.read_sql(select([SurveyResponses.__table__]), engine)
+        data_df['date'] = data_df['time'].map(convert_quarter_to_datetime)
+        return data_df
+
+    def sample_sizes():
+        # Counted from the respondent table, independently of the user counts they are the denominator of
+        stmt = select([
+            SurveyTimes.time,
+            SurveyCountries.region,
+            func.count(SurveyRespondents.respondent_pk.distinct()).label('sample_size')
+        ]).select_from(
+            SurveyRespondents.__table__
+            .join(SurveyTimes.__table__, SurveyRespondents.time_pk == SurveyTimes.pk)
+            .join(SurveyCountries.__table__, SurveyRespondents.country == SurveyCountries.country)
+        ).group_by(SurveyTimes.time, SurveyCountries.region)
+        sizes = pd.read_sql(stmt, engine)
+        sizes.insert(0, 'date', sizes.pop('time').map(convert_quarter_to_datetime))
+        return sizes
+
+    rng = np.random.default_rng(1)
+    ceilings = {region: float(rng.uniform(0.5, 0.95)) for region in dims['regions']}
+    forecast = load_module(path('monthly_user_forecast.py'), dict(
+        stand_in, data_export=survey_export, get_sample_sizes=sample_sizes,
+        get_user_counts=cte['get_user_counts'], ceilings=ceilings))
+    forecast['skipped_regions'] = []
+
+    master_table = _master_table(dims)
+    basic_data = pd.DataFrame([(convert_quarter_to_datetime(t), t, dims['region_of'][territory], territory)
+                               for t in dims['times'] for territory in dims['territories']],
+                              columns=['date', 'time', 'region', 'territory'])
+    basic_data['economy_metric'] = rng.uniform(1, 100, len(basic_data))
+    basic_data['currency'] = 'USD'
+    basic_data['exchange_rate'] = rng.uniform(0.5, 2, len(basic_data))
+    revenue = load_module(path('revenue_calculator.py'), dict(
+        stand_in, master_table=master_table, basic_data_export=lambda: basic_data.copy()))
+
+    # Only update_workbook is timed, and its export stages and configuration are imported lazily
+    workbook = load_module(path('update_excel_files.py'), stand_in)
+    workbook_path = os.path.join(workdir, 'benchmark.xlsx')
+
+    market_data = {}
+
+    def market_export():
+        market_data['df'] = data_export['data_export']()
+        return market_data['df']
+
+    def workbook_update():
+        from openpyxl import Workbook
+        df = market_data.get('df')
+        if df is None:
+            df = data_export['data_export']()
+        Workbook().save(workbook_path)
+        # Excel sheets hold at most 1,048,576 rows
+        sheet = df.head(1048575)
+        return workbook['update_workbook'](workbook_path, {'market': [sheet, 'Market_Share']}, tab_color='000000')
+
+    user_data = {}
+
+    def extract_user_data():
+        user_data['df'] = forecast['extract_user_data']()
+        return user_data['df']
+
+    def regional_forecast():
+        df = user_data.get('df')
+        if df is None:
+            df = forecast['extract_user_data']()
+        regions = [region for region in forecast['regions'] if region not in forecast['skipped_regions']]
+        return pd.concat(forecast['forecast_regions_batched'](df, regions, ceilings))
+
+    return {
+        'data_pull.data_export': data_pull['data_export'],
+        'data_export.data_export': market_export,
+        'get_data': cte['get_data'],
+        'metric_calculator': lambda: revenue['metric_calculator'](basic_data.copy(), master_table.copy()),
+        'extract_user_data': extract_user_data,
+        'regional_forecast': regional_forecast,
+        'workbook_update': workbook_update
+    }
+
+def _time_stage(stage, measure_memory):
+    """
+    Runs one stage and returns its wall time, peak traced memory and output rows.
+    """
+    if measure_memory:
+        tracemalloc.start()
+    start = time.perf_counter()
+    result = stage()
+    seconds = time.perf_counter() - start
+    peak = None
+    if measure_memory:
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    rows = len(result) if hasattr(result, '__len__') else None
+    return {'seconds': round(seconds, 4),
+            'peak_mb': round(peak / 2**20, 2) if peak is not None else None,
+            'rows_out': rows}
+
+def run_benchmark(rows, db_path, stages=None, measure_memory=True, regenerate=True, seed=0):
+    """
+    Generates the data and times every stage.
+
+    Parameters:
+    - rows (int): The approximate number of rows of each fact table.
+    - db_path (str): The path of the SQLite database.
+    - stages (list): The stages to run. Defaults to every stage.
+    - measure_memory (bool): If True, the peak memory of each stage is traced with tracemalloc,
+      which also slows the stages down somewhat.
+    - regenerate (bool): If False, an existing database at db_path is reused.
+    - seed (int): The seed of the random generator.
+
+    Returns:
+    - results (dict): The scale of the run and the seconds, peak_mb and rows_out of each stage.
+    """
+    engine = sa.create_engine(f"sqlite:///{db_path}")
+    if regenerate or not os.path.exists(db_path):
+        start = time.perf_counter()
+        generate_data(engine, rows, seed=seed)
+        print(f"Data generated in {time.perf_counter() - start:.1f}s.")
+    dims = _dimensions(rows)
+
+    results = {'rows': rows, 'created': pd.Timestamp.now().isoformat(), 'python': sys.version.split()[0],
+               'pandas': pd.__version__, 'stages': {}}
+    with tempfile.TemporaryDirectory() as workdir:
+        stage_functions = build_stages(engine, dims, workdir)
+        for name in stages or list(stage_functions):
+            print(f"Running {name}...")
+            results['stages'][name] = _time_stage(stage_functions[name], measure_memory)
+    return results
+
+def compare_to_baseline(results, baseline, threshold=1.2):
+    """
+    Reports the stages that got slower than the baseline.
+
+    Parameters:
+    - results (dict): The output of run_benchmark.
+    - baseline (dict): A previous output of run_benchmark.
+    - threshold (float): The ratio of the new to the baseline time above which a stage counts as a regression.
+
+    Returns:
+    - regressions (list): The names of the stages that are slower than the threshold allows.
+    """
+    if baseline.get('rows') != results.get('rows'):
+        print(f"Warning: the baseline was run with {baseline.get('rows'):,} rows, this run with {results.get('rows'):,}.")
+
+    regressions = []
+    print(f"{'stage':<26}{'baseline s':>12}{'new s':>10}{'ratio':>8}{'base MB':>10}{'new MB':>10}")
+    for name, new in results['stages'].items():
+        old = baseline.get('stages', {}).get(name)
+        if old is None:
+            print(f"{name:<26}{'-':>12}{new['seconds']:>10.3f}")
+            continue
+        ratio = new['seconds'] / old['seconds'] if old['seconds'] else float('inf')
+        flag = '  REGRESSION' if ratio > threshold else ''
+        print(f"{name:<26}{old['seconds']:>12.3f}{new['seconds']:>10.3f}{ratio:>8.2f}"
+              f"{old['peak_mb'] or 0:>10.1f}{new['peak_mb'] or 0:>10.1f}{flag}")
+        if ratio > threshold:
+            regressions.append(name)
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the pipeline stages against a local SQLite stand-in.")
+    parser.add_argument('--rows', type=int, default=10000, help="approximate rows per fact table (10k to 100M)")
+    parser.add_argument('--db', default=os.path.join(tempfile.gettempdir(), 'pipeline_benchmark.sqlite'),
+                        help="path of the SQLite stand-in")
+    parser.add_argument('--reuse-db', action='store_true', help="reuse existing generated data at --db")
+    parser.add_argument('--stages', help="comma-separated stages to run, default all")
+    parser.add_argument('--output', help="write the results to this JSON file")
+    parser.add_argument('--baseline', help="compare against this JSON file from an earlier run")
+    parser.add_argument('--threshold', type=float, default=1.2, help="slowdown ratio that counts as a regression")
+    parser.add_argument('--no-memory', action='store_true', help="skip tracemalloc peak memory tracing")
+    args = parser.parse_args(argv)
+
+    stages = args.stages.split(',') if args.stages else None
+    results = run_benchmark(args.rows, args.db, stages=stages, measure_memory=not args.no_memory,
+                            regenerate=not args.reuse_db)
+
+    print(json.dumps(results['stages'], indent=2))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+        print(f"Results written to {args.output}.")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare_to_baseline(results, baseline, threshold=args.threshold)
+        return 1 if regressions else 0
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
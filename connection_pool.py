@@ -0,0 +1,76 @@
+"""
+This module holds one pooled SQLAlchemy engine that is shared by the exports of this package in the process.
+
+Opening a new engine for each export means paying the connection setup again for every query.
+The shared engine keeps a small pool of open connections that are handed out to sessions and returned
+when the session is closed. Sessions are cheap and thread-safe to create, so exports running concurrently
+on a thread pool each get their own session on the same pool.
+
+Only the exports that open their sessions with pooled_session use the pool: data_pull, data_export and
+data_extract_common_table_expressions. The src exports that update_excel_files runs, e.g. basics_export and the
+cost, usage and viewing calculators, still open their own connections with establish_connection and are not
+covered.
+
+The engine is the one establish_connection builds, so it keeps the connect_args, creator and pool options
+configured there. Only the first session is opened through establish_connection, every later session is
+opened on its engine.
+
+Functions:
+----------
+shared_engine(): returns the pooled engine, creating it on first use
+pooled_session(): opens a session on the pooled engine
+dispose_shared_engine(): closes every pooled connection
+
+Module imports:
+---------------
+src.utils.data_export_funcs.establish_connection: builds the engine of the warehouse
+"""
+
+import threading
+
+from sqlalchemy.orm import sessionmaker
+
+from src.utils.data_export_funcs import establish_connection
+
+_engine = None
+_session_factory = None
+_lock = threading.Lock()
+
+def shared_engine():
+    """
+    Returns the pooled engine, creating it on first use.
+
+    Returns:
+    - engine (SQLAlchemy Engine): The engine shared by the pooled exports in the process.
+    """
+    global _engine, _session_factory
+    with _lock:
+        if _engine is None:
+            # Reuse the engine establish_connection builds rather than a copy made from its URL,
+            # which would drop its connect_args, creator and engine options
+            session = establish_connection()
+            _engine = session.get_bind()
+            session.close()
+            _session_factory = sessionmaker(bind=_engine)
+    return _engine
+
+def pooled_session():
+    """
+    Opens a session on the pooled engine. Closing the session returns its connection to the pool.
+
+    Returns:
+    - session (SQLAlchemy Session): A new session bound to the shared engine.
+    """
+    shared_engine()
+    return _session_factory()
+
+def dispose_shared_engine():
+    """
+    Closes every pooled connection, e.g. at the end of a refresh or before forking worker processes.
+    """
+    global _engine, _session_factory
+    with _lock:
+        if _engine is not None:
+            _engine.dispose()
+        _engine = None
+        _session_factory = None
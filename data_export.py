@@ -1,21 +1,37 @@
-def data_export(t1=TableOne, t2=TableTwo, t3=TableThree):
-    """
-    Export the data from the database into a dataframe.
+import os
 
-    This function connects to the database, executes a SQL query to retrieve the data from joined tables,
-    and manipulates the resulting data in a pandas dataframe. The dataframe is then cleaned, sorted, and finally returned. 
+from connection_pool import pooled_session
+from instrumentation import span, traced
+from query_cache import cached_read_sql
+from schema import apply_schema, register_categories
+
+market_share_snapshot_path = os.path.join(os.path.expanduser('~'), '.cache', 'market_share_snapshot.parquet')
+
+def market_share_statement(t1=TableOne, t2=TableTwo, times=None, territories=None, query_mode='join'):
+    """
+    Build the SQL query for the subscription and revenue market shares, in local currency.
+    The revenue is converted afterwards with convert_market_shares, for any number of rate types.
 
     Parameters:
     - t1 (SQLAlchemy Table): First table.
     - t2 (SQLAlchemy Table): Second table.
-    - t3 (SQLAlchemy Table): Third table.
+    - times (list): The times to select. Defaults to time_range.
+    - territories (list): The territories to select. Defaults to countries.
+    - query_mode (str): 'join' joins the first table to an aggregated subquery of itself for the totals.
+      'window' computes the totals with SUM(...) OVER (PARTITION BY time, territory) in a single pass.
+      Both return identical results.
 
     Returns:
-    - data_df (pandas.DataFrame): DataFrame with data for specified parameters and date range.
+    - stmt (SQLAlchemy Select): The market share query.
     """
-    session = establish_connection()
-    
-    print("Building SQL query for data...")
+    times = time_range if times is None else times
+    territories = countries if territories is None else territories
+
+    if query_mode == 'window':
+        return _window_market_share_statement(t1, t2, times, territories)
+    if query_mode != 'join':
+        raise ValueError(f"Unknown query mode '{query_mode}'. Use 'join' or 'window'.")
+
     # Create subquery for total subscriptions and revenue
     subq = select([
         t1.time,
@@ -38,40 +54,88 @@ def data_export(t1=TableOne, t2=TableTwo, t3=TableThree):
         subq.c.total_subs,
         label('subscriptions_market_share', (func.max(t1.subscriptions) / subq.c.total_subs)),
         func.max(t1.revenue).label('revenue_loc'),
-        label('revenue_usd', (func.max(t1.revenue) / t3.exchange_rate)),
         subq.c.total_revenue_loc,
-        label('total_revenue_usd', (func.max(t1.revenue) / t3.exchange_rate)),
         label('revenue_market_share', (func.max(t1.revenue) / subq.c.total_revenue_loc)),
         t1.currency,
-        t3.output_currency,
-        t3.exchange_rate,
-        t3.exchange_rate_type,
         t1.forecast_flag,
         t1.update_time,
         label('last_db_pull', func.current_date())   
     ]).select_from(
         t1.__table__
-        .join(t3.__table__, (t1.time == t3.time) & (t1.currency == t3.input_currency))
         .join(t2.__table__, t1.territory == t2.country)
         .join(subq, and_(t1.time == subq.c.time, t1.territory == subq.c.territory))  # Join with the subquery
     ).where(
-        t3.exchange_rate_type == 'Fixed',
-        t1.time.in_(time_range),
-        t1.territory.in_(countries),
+        t1.time.in_(times),
+        t1.territory.in_(territories),
         t1.business_line == 'Business Line'
     ).group_by(
         t1.time, t1.territory, t2.region, t1.company, t1.business_line,
-        t1.currency, t3.output_currency, t3.exchange_rate, t3.exchange_rate_type,
-        t1.forecast_flag, t1.update_time, subq.c.total_subs, subq.c.total_revenue_loc
+        t1.currency, t1.forecast_flag, t1.update_time, subq.c.total_subs, subq.c.total_revenue_loc
     )
-    
-    print("Executing SQL query for data and loading the results into a dataframe...")
-    data_df = pd.read_sql(stmt, session.bind)
+    return stmt
 
-    print("Closing database connection...")
-    session.close()
+def _window_market_share_statement(t1, t2, times, territories):
+    """
+    Build the market share query with window functions, scanning the first table once.
+
+    The totals are window sums over the raw rows of each (time, territory), like the sums of the aggregated
+    subquery in the join variant. Filtering on time and territory before the window does not change them,
+    because both are partition keys.
+    """
+    partition = [t1.time, t1.territory]
+    rows = select([
+        t1.time,
+        t1.territory,
+        t1.company,
+        t1.business_line,
+        t1.subscriptions,
+        t1.revenue,
+        t1.currency,
+        t1.forecast_flag,
+        t1.update_time,
+        func.sum(t1.subscriptions).over(partition_by=partition).label('total_subs'),
+        func.sum(t1.revenue).over(partition_by=partition).label('total_revenue_loc')
+    ]).where(
+        t1.time.in_(times),
+        t1.territory.in_(territories),
+        t1.business_line == 'Business Line'
+    ).alias('rows')
+
+    stmt = select([
+        rows.c.time,
+        rows.c.territory,
+        t2.region,
+        rows.c.company,
+        rows.c.business_line,
+        func.max(rows.c.subscriptions).label('subscriptions'),
+        rows.c.total_subs,
+        label('subscriptions_market_share', (func.max(rows.c.subscriptions) / rows.c.total_subs)),
+        func.max(rows.c.revenue).label('revenue_loc'),
+        rows.c.total_revenue_loc,
+        label('revenue_market_share', (func.max(rows.c.revenue) / rows.c.total_revenue_loc)),
+        rows.c.currency,
+        rows.c.forecast_flag,
+        rows.c.update_time,
+        label('last_db_pull', func.current_date())
+    ]).select_from(
+        rows
+        .join(t2.__table__, rows.c.territory == t2.country)
+    ).group_by(
+        rows.c.time, rows.c.territory, t2.region, rows.c.company, rows.c.business_line,
+        rows.c.currency, rows.c.forecast_flag, rows.c.update_time, rows.c.total_subs, rows.c.total_revenue_loc
+    )
+    return stmt
 
-    print("Cleaning and sorting the dataframe...")
+def clean_market_share_data(data_df):
+    """
+    Clean, sort and reorder the columns of the market share query results.
+
+    Parameters:
+    - data_df (pandas.DataFrame): The raw results of the market share query.
+
+    Returns:
+    - data_df (pandas.DataFrame): The cleaned dataframe.
+    """
     data_df = clean_timestamps(data_df)
     data_df.sort_values(['territory','date'], inplace=True)
     data_df.reset_index(drop=True, inplace=True)  # reset the index to start at 0
@@ -81,8 +145,263 @@ def data_export(t1=TableOne, t2=TableTwo, t3=TableThree):
     cols = cols[-3:] + cols[:-3]
     cols.insert(1, cols.pop(3))
     data_df = data_df[cols]
+    return data_df
+
+def exchange_rates_statement(t3=TableThree, times=None, rate_types=('Fixed',), output_currencies=None):
+    """
+    Build the SQL query for the exchange rate lookup.
+
+    Parameters:
+    - t3 (SQLAlchemy Table): Third table.
+    - times (list): The times to select. Defaults to time_range.
+    - rate_types (list): The exchange rate types to select, e.g. ['Fixed', 'Floating']. None selects every type.
+    - output_currencies (list): The output currencies to select, e.g. ['USD', 'EUR']. None selects every currency.
+
+    Returns:
+    - stmt (SQLAlchemy Select): The exchange rate query.
+    """
+    times = time_range if times is None else times
+    conditions = [t3.time.in_(times)]
+    if rate_types is not None:
+        conditions.append(t3.exchange_rate_type.in_(rate_types))
+    if output_currencies is not None:
+        conditions.append(t3.output_currency.in_(output_currencies))
+
+    # Distinct, like the GROUP BY of the former single-query export
+    stmt = select([
+        t3.time,
+        t3.input_currency,
+        t3.output_currency,
+        t3.exchange_rate,
+        t3.exchange_rate_type
+    ]).where(*conditions).distinct()
+    return stmt
+
+def convert_market_shares(data_df, rates_df):
+    """
+    Join the exchange rate lookup to the market shares and convert the revenue for every rate at once.
+
+    Each row is repeated for every exchange rate of its time and currency, so several rate types or output
+    currencies come out as one long dataframe. Rows without an exchange rate are dropped.
+
+    Parameters:
+    - data_df (pandas.DataFrame): The cleaned market shares in local currency.
+    - rates_df (pandas.DataFrame): The exchange rate lookup from exchange_rates_statement.
+
+    Returns:
+    - data_df (pandas.DataFrame): The market shares with revenue_usd, total_revenue_usd and the exchange rate columns.
+    """
+    columns = data_df.columns.tolist()
+    columns.insert(columns.index('revenue_loc') + 1, 'revenue_usd')
+    columns.insert(columns.index('total_revenue_loc') + 1, 'total_revenue_usd')
+    position = columns.index('currency') + 1
+    columns[position:position] = ['output_currency', 'exchange_rate', 'exchange_rate_type']
+
+    rates_df = rates_df.dropna(subset=['time', 'input_currency']).rename(columns={'input_currency': 'currency'})
+    # An inner merge keeps the order of data_df, so the rows stay sorted by territory and date
+    data_df = data_df.merge(rates_df, on=['time', 'currency'], how='inner')
+
+    revenue_usd = data_df['revenue_loc'].to_numpy() / data_df['exchange_rate'].to_numpy()
+    data_df['revenue_usd'] = revenue_usd
+    data_df['total_revenue_usd'] = revenue_usd
+    return data_df[columns]
+
+def load_exchange_rates(t3=TableThree, rate_types=('Fixed',), output_currencies=None):
+    """
+    Load the exchange rate lookup for the export times.
+
+    Parameters:
+    - t3 (SQLAlchemy Table): Third table.
+    - rate_types (list): See exchange_rates_statement.
+    - output_currencies (list): See exchange_rates_statement.
+
+    Returns:
+    - rates_df (pandas.DataFrame): The exchange rates.
+    """
+    session = pooled_session()
+    with span('data_export.load_rates', "Loading the exchange rates...", rate_types=rate_types) as s:
+        rates_df = pd.read_sql(exchange_rates_statement(t3, rate_types=rate_types, output_currencies=output_currencies),
+                               session.bind)
+        s.frame_out(rates_df)
+    session.close()
+    return rates_df
+
+@traced('data_export.data_export')
+def data_export(t1=TableOne, t2=TableTwo, t3=TableThree, use_cache=False, incremental=False,
+                snapshot_path=market_share_snapshot_path, query_mode='join', rate_types=('Fixed',),
+                output_currencies=None):
+    """
+    Export the data from the database into a dataframe.
+
+    This function connects to the database, executes a SQL query to retrieve the data from joined tables,
+    and manipulates the resulting data in a pandas dataframe. The dataframe is then cleaned, sorted, and finally returned. 
+
+    The market shares are pulled once in local currency. The exchange rates are pulled as a small lookup and
+    joined in pandas, so several rate types or output currencies cost one pass over the first table. The result
+    has one row per market share row and exchange rate, told apart by exchange_rate_type and output_currency.
+
+    Parameters:
+    - t1 (SQLAlchemy Table): First table.
+    - t2 (SQLAlchemy Table): Second table.
+    - t3 (SQLAlchemy Table): Third table.
+    - use_cache (bool): If True, the market shares are loaded from the local query cache while the max update_time
+      of the first table is unchanged since the cached pull. The exchange rates are always read from the database.
+    - incremental (bool): If True, only the (time, territory) groups with rows that are newer than the local
+      snapshot are pulled and recomputed, and they are merged into the snapshot at snapshot_path.
+    - snapshot_path (str): The Parquet file of the local snapshot used by the incremental mode.
+    - query_mode (str): 'join' or 'window', see market_share_statement.
+    - rate_types (list): The exchange rate types to convert with, e.g. ['Fixed', 'Floating']. None converts
+      with every type.
+    - output_currencies (list): The currencies to convert to, e.g. ['USD', 'EUR']. None converts to every currency.
+
+    Returns:
+    - data_df (pandas.DataFrame): DataFrame with data for specified parameters and date range.
+    """
+    if incremental:
+        data_df = incremental_market_shares(t1, t2, snapshot_path=snapshot_path, query_mode=query_mode)
+    else:
+        data_df = _load_market_shares(t1, t2, use_cache=use_cache, query_mode=query_mode)
+
+    rates_df = load_exchange_rates(t3, rate_types=rate_types, output_currencies=output_currencies)
+
+    with span('data_export.convert', "Converting the revenue...") as s:
+        s.frame_in(data_df)
+        data_df = convert_market_shares(data_df, rates_df)
+        s.frame_out(data_df)
+
+    # Shared categorical dtypes for the identifier columns
+    register_categories('territory', countries)
+    if rate_types is not None:
+        register_categories('rate_type', rate_types)
+    if output_currencies is not None:
+        register_categories('currency', output_currencies)
+    data_df = apply_schema(data_df, 'data_export.data_export')
 
     print("Data dataframe export complete.")
     print("")
     return data_df
-  
+
+def _load_market_shares(t1, t2, use_cache=False, query_mode='join'):
+    """
+    Load and clean the market shares in local currency for every time and territory of the export.
+    """
+    session = pooled_session()
+    
+    stmt = market_share_statement(t1, t2, query_mode=query_mode)
+    
+    with span('data_export.load', "Executing SQL query for data and loading the results into a dataframe...",
+              cached=use_cache, query_mode=query_mode) as s:
+        if use_cache:
+            data_df = cached_read_sql(stmt, session.bind,
+                                      params={'time_range': time_range, 'countries': countries},
+                                      watermark_stmt=select([func.max(t1.update_time)]))
+        else:
+            data_df = pd.read_sql(stmt, session.bind)
+        s.frame_out(data_df)
+
+    session.close()
+
+    with span('data_export.transform', "Cleaning and sorting the dataframe...") as s:
+        s.frame_in(data_df)
+        data_df = clean_market_share_data(data_df)
+        s.frame_out(data_df)
+    return data_df
+
+def incremental_market_shares(t1=TableOne, t2=TableTwo, snapshot_path=market_share_snapshot_path, query_mode='join'):
+    """
+    Load the market shares incrementally, starting from the last successful pull stored in a local snapshot.
+
+    The market shares of a (time, territory) group depend on every row of the group, so a group is recomputed
+    in full as soon as one of its rows has an update_time newer than the snapshot, or when the group is not
+    in the snapshot yet. All other groups are taken from the snapshot as they are.
+
+    The snapshot holds the market shares in local currency. The exchange rates are joined on every run,
+    so a change of rate types or a revised rate never leaves stale conversions behind.
+
+    Parameters:
+    - t1 (SQLAlchemy Table): First table.
+    - t2 (SQLAlchemy Table): Second table.
+    - snapshot_path (str): The Parquet file of the local snapshot. It is created by the first run.
+    - query_mode (str): 'join' or 'window', see market_share_statement.
+
+    Returns:
+    - data_df (pandas.DataFrame): The cleaned market shares in local currency.
+    """
+    snapshot = pd.read_parquet(snapshot_path) if os.path.exists(snapshot_path) else None
+    if snapshot is not None and 'exchange_rate' in snapshot.columns:
+        print("The local snapshot holds converted revenue from an older export, rebuilding it...")
+        snapshot = None
+    if snapshot is None or snapshot.empty:
+        print("No local snapshot found, running a full export...")
+        data_df = _load_market_shares(t1, t2, query_mode=query_mode)
+        _save_snapshot(data_df, snapshot_path)
+        return data_df
+
+    # Drop groups that are no longer part of the export parameters
+    snapshot = snapshot[snapshot['time'].isin(time_range) & snapshot['territory'].isin(countries)]
+    watermark = snapshot['update_time'].max()
+    known_groups = set(zip(snapshot['time'], snapshot['territory']))
+
+    session = pooled_session()
+
+    groups_stmt = select([t1.time, t1.territory]).where(
+        t1.time.in_(time_range),
+        t1.territory.in_(countries),
+        t1.business_line == 'Business Line'
+    ).group_by(
+        t1.time, t1.territory
+    ).having(
+        func.max(t1.update_time) > watermark
+    )
+    all_groups_stmt = select([t1.time, t1.territory]).where(
+        t1.time.in_(time_range),
+        t1.territory.in_(countries),
+        t1.business_line == 'Business Line'
+    ).distinct()
+    with span('data_export.find_changes', f"Finding the groups that changed since {watermark}...") as s:
+        changed = set(map(tuple, pd.read_sql(groups_stmt, session.bind).itertuples(index=False)))
+        new = set(map(tuple, pd.read_sql(all_groups_stmt, session.bind).itertuples(index=False))) - known_groups
+        affected = changed | new
+        s.set(changed_groups=len(changed), new_groups=len(new))
+
+    if not affected:
+        session.close()
+        print("No changes since the last pull.")
+        return snapshot.reset_index(drop=True)
+
+    stmt = market_share_statement(t1, t2,
+                                  times=sorted({time for time, _ in affected}),
+                                  territories=sorted({territory for _, territory in affected}),
+                                  query_mode=query_mode)
+    with span('data_export.load', f"Recomputing {len(affected)} (time, territory) groups...",
+              incremental=True, query_mode=query_mode) as s:
+        update_df = pd.read_sql(stmt, session.bind)
+        s.frame_out(update_df)
+    session.close()
+
+    with span('data_export.transform') as s:
+        s.frame_in(update_df)
+        # The query selects every combination of the affected times and territories, keep only the affected groups
+        update_df = update_df[[group in affected for group in zip(update_df['time'], update_df['territory'])]]
+        update_df = clean_market_share_data(update_df)
+
+        unchanged = snapshot[[group not in affected for group in zip(snapshot['time'], snapshot['territory'])]]
+        data_df = pd.concat([unchanged, update_df[snapshot.columns]], ignore_index=True)
+        data_df.sort_values(['territory','date'], inplace=True)
+        data_df.reset_index(drop=True, inplace=True)
+        s.frame_out(data_df)
+
+    with span('data_export.save'):
+        _save_snapshot(data_df, snapshot_path)
+    return data_df
+
+def _save_snapshot(data_df, snapshot_path):
+    """
+    Write the snapshot to a temporary file first, so an interrupted run keeps the previous snapshot.
+    """
+    directory = os.path.dirname(snapshot_path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    temp_path = snapshot_path + '.tmp'
+    data_df.to_parquet(temp_path, index=False)
+    os.replace(temp_path, snapshot_path)
@@ -1,21 +1,25 @@
-def get_data(t1=TableOne, t2=TableTwo, t3=TableThree, t4=TableFour):
+import os
+
+from connection_pool import pooled_session
+from instrumentation import span, traced
+from period_parsing import parse_periods
+from query_cache import cached_read_sql
+from schema import apply_schema, register_categories
+
+def get_data_statement(session, t1=TableOne, t2=TableTwo, t3=TableThree, t4=TableFour):
     """
-    Function to export data based on given parameters. 
+    Function to build the query behind get_data.
 
     Parameters:
+    session: An open database session.
     t1: TableOne.
     t2: TableTwo.
     t3: TableThree.
     t4: TableFour.
 
     Returns:
-    A cleaned dataframe containing combined data.
+    The select statement combining the user counts with the sample sizes.
     """
-
-    session = establish_connection()
-
-    # Core data query
-    print("Querying core data...")
     size_subquery = session.query(
         t1.time_pk,
         func.count(t1.respondent_pk.distinct()).label('sample_size'),
@@ -62,17 +66,223 @@ def get_data(t1=TableOne, t2=TableTwo, t3=TableThree, t4=TableFour):
             data_cte.join(n_cte, and_(data_cte.c.time_pk == n_cte.c.time_pk,
                                      data_cte.c.country == n_cte.c.country))
         )
+    return stmt
+
+def get_data_watermark(t1=TableOne, t4=TableFour):
+    """
+    Function to build the cache watermark of get_data.
+
+    The survey tables have no update_time, so the watermark combines the row count and latest time_pk of
+    TableOne (the sample sizes) and TableFour, and the number of TableFour rows used in the month, so flipping
+    used_in_month on a row expires the cache. TableTwo and TableThree are small lookups and are part of the
+    cache key in full instead, see get_data.
+
+    Parameters:
+    t1: TableOne.
+    t4: TableFour.
+
+    Returns:
+    A select statement returning one row.
+    """
+    return select([
+        select([func.count(t1.respondent_pk)]).scalar_subquery(),
+        select([func.max(t1.time_pk)]).scalar_subquery(),
+        select([func.count(t4.respondent_pk)]).scalar_subquery(),
+        select([func.max(t4.time_pk)]).scalar_subquery(),
+        select([func.count(t4.respondent_pk)]).where(t4.used_in_month == 'Yes').scalar_subquery()
+    ])
+
+def _register_categories(session, t3=TableThree, t4=None):
+    """
+    Function to register the category sets of get_data before its frames are converted.
+
+    The territories and regions come from the configured countries and the TableThree lookup the query joins,
+    so every frame, and every iter_data partition, gets the same categorical dtypes whatever rows it holds.
+    With t4, the online services are registered as well, for the partitions of iter_data.
+    """
+    register_categories('territory', countries)
+    lookup = pd.read_sql(select([t3.country, t3.region]), session.bind)
+    register_categories('territory', lookup['country'])
+    register_categories('region', lookup['region'])
+    if t4 is not None:
+        services = pd.read_sql(select([t4.online_service]).distinct(), session.bind)
+        register_categories('online_service', services['online_service'])
+
+@traced('get_data.get_data')
+def get_data(t1=TableOne, t2=TableTwo, t3=TableThree, t4=TableFour, use_cache=False):
+    """
+    Function to export data based on given parameters. 
 
-    print("Loading data into a pandas DataFrame...")
-    data_df = pd.read_sql(stmt, session.bind)
+    Parameters:
+    t1: TableOne.
+    t2: TableTwo.
+    t3: TableThree.
+    t4: TableFour.
+    use_cache: If True, the results are loaded from the local query cache while the watermark of TableOne and
+        TableFour (see get_data_watermark) and the contents of TableTwo and TableThree are unchanged since the
+        cached pull. In-place edits that keep those counts, e.g. moving a respondent to another country or
+        swapping used_in_month between two rows, are not detected: run with use_cache=False or clear the
+        query cache after revising survey data.
+
+    Returns:
+    A cleaned dataframe containing combined data.
+    """
+
+    session = pooled_session()
+
+    # Core data query
+    print("Querying core data...")
+    stmt = get_data_statement(session, t1, t2, t3, t4)
+
+    with span('get_data.load', "Loading data into a pandas DataFrame...", cached=use_cache) as s:
+        if use_cache:
+            # The period and region lookups are small, so their full contents are part of the cache key
+            lookups = {
+                'periods': [list(row) for row in session.execute(select([t2.pk, t2.time]).order_by(t2.pk))],
+                'regions': [list(row) for row in session.execute(select([t3.country, t3.region]).order_by(t3.country))]
+            }
+            data_df = cached_read_sql(stmt, session.bind, params=lookups,
+                                      watermark_stmt=get_data_watermark(t1, t4))
+        else:
+            data_df = pd.read_sql(stmt, session.bind)
+        s.frame_out(data_df)
+    _register_categories(session, t3)
     session.close()
-    data_df['last_update'] = pd.to_datetime('today').strftime("%Y-%m-%d")
+
+    with span('get_data.transform') as s:
+        s.frame_in(data_df)
+        data_df['last_update'] = pd.to_datetime('today').strftime("%Y-%m-%d")
+        data_df['forecast_flag'] = 'A'
+        data_df['date'] = parse_periods(data_df['time'], convert_quarter_to_datetime)
+        # Move 'date' to second position in the columns
+        cols = data_df.columns.tolist()
+        cols = cols[:1] + cols[-1:] + cols[1:-1]
+        data_df = data_df[cols]
+        data_df.sort_values(['territory','online_service','date'], inplace=True)
+        data_df.reset_index(inplace=True, drop=True)
+        s.frame_out(data_df)
+
+    # Shared categorical dtypes for the identifier columns
+    data_df = apply_schema(data_df, 'get_data')
+    return data_df
+
+def _prepare_data_chunk(data_df, last_update):
+    """
+    Function to add the derived columns to a chunk of get_data results.
+    """
+    data_df['last_update'] = last_update
     data_df['forecast_flag'] = 'A'
-    data_df['date'] = data_df['time'].apply(convert_quarter_to_datetime)
+    data_df['date'] = parse_periods(data_df['time'], convert_quarter_to_datetime)
     # Move 'date' to second position in the columns
     cols = data_df.columns.tolist()
     cols = cols[:1] + cols[-1:] + cols[1:-1]
-    data_df = data_df[cols]
+    return data_df[cols]
+
+def _finish_territory(chunks):
+    """
+    Function to combine and sort the chunks of one territory.
+    """
+    data_df = pd.concat(chunks, ignore_index=True)
     data_df.sort_values(['territory','online_service','date'], inplace=True)
     data_df.reset_index(inplace=True, drop=True)
-    return data_df
+    return apply_schema(data_df, report=False)
+
+def iter_data(t1=TableOne, t2=TableTwo, t3=TableThree, t4=TableFour, chunksize=100000):
+    """
+    Function to stream the get_data results territory by territory.
+
+    The query is ordered by territory and read in chunks through a server-side cursor, so at most one
+    territory plus one chunk is held in memory at a time.
+
+    Parameters:
+    t1: TableOne.
+    t2: TableTwo.
+    t3: TableThree.
+    t4: TableFour.
+    chunksize: The number of rows fetched from the database at a time.
+
+    Yields:
+    One cleaned dataframe per territory, in the same format and order as get_data.
+    """
+    session = pooled_session()
+    stmt = get_data_statement(session, t1, t2, t3, t4)
+    stmt = stmt.order_by('territory')
+    last_update = pd.to_datetime('today').strftime("%Y-%m-%d")
+
+    print("Streaming data by territory...")
+    try:
+        # Register every category up front, so the partitions share their categorical dtypes
+        _register_categories(session, t3, t4)
+        with session.bind.connect().execution_options(stream_results=True) as connection:
+            pending = []
+            for chunk in pd.read_sql(stmt, connection, chunksize=chunksize):
+                chunk = _prepare_data_chunk(chunk, last_update)
+                # Split the chunk at territory boundaries, a territory can span several chunks
+                for territory, group in chunk.groupby('territory', sort=False):
+                    if pending and pending[0]['territory'].iat[0] != territory:
+                        yield _finish_territory(pending)
+                        pending = []
+                    pending.append(group)
+            if pending:
+                yield _finish_territory(pending)
+    finally:
+        session.close()
+
+def write_data_partitions(output_dir, t1=TableOne, t2=TableTwo, t3=TableThree, t4=TableFour, chunksize=100000):
+    """
+    Function to stream the get_data results to one sorted Parquet file per territory.
+
+    Parameters:
+    output_dir: The directory to write the partitions to.
+    t1: TableOne.
+    t2: TableTwo.
+    t3: TableThree.
+    t4: TableFour.
+    chunksize: The number of rows fetched from the database at a time.
+
+    Returns:
+    A list with the path of each partition.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    paths = []
+    for data_df in iter_data(t1, t2, t3, t4, chunksize=chunksize):
+        territory = data_df['territory'].iat[0]
+        path = os.path.join(output_dir, f"territory={territory}.parquet")
+        with span('get_data.save', territory=territory) as s:
+            data_df.to_parquet(path, index=False)
+            s.frame_in(data_df)
+        paths.append(path)
+    print(f"Wrote {len(paths)} territory partitions to {output_dir}.")
+    return paths
+
+def get_user_counts(t5=TableFive, services=('service_1', 'service_2', 'service_3', 'service_4', 'service_5', 'other_services')):
+    """
+    Function to count the users of each service per (date, area, region) in the database.
+
+    Only the group-level counts are transferred instead of one row per respondent. A respondent counts
+    towards a service when the service column is non-zero, as with replace(0, np.nan).count() in pandas.
+    The sample sizes are not part of the query, get_sample_sizes stays the source of the denominator.
+
+    Parameters:
+    t5: TableFive, the respondent-level survey data with one column per service.
+    services: The service columns to count.
+
+    Returns:
+    A dataframe with the date, area, region and the user count of each service.
+    """
+    session = pooled_session()
+
+    stmt = select([t5.time, t5.area, t5.region] + [
+        func.count(case([(getattr(t5, service) != 0, 1)])).label(service) for service in services
+    ]).group_by(t5.time, t5.area, t5.region)
+
+    with span('get_user_counts.load', "Querying user counts per service...") as s:
+        counts_df = pd.read_sql(stmt, session.bind)
+        s.frame_out(counts_df)
+    session.close()
+
+    counts_df.insert(0, 'date', parse_periods(counts_df['time'], convert_quarter_to_datetime))
+    counts_df.drop(columns=['time'], inplace=True)
+    counts_df.sort_values(['date','area','region'], inplace=True)
+    counts_df.reset_index(inplace=True, drop=True)
+    return counts_df
@@ -1,63 +1,129 @@
-def data_export(t1=TableOne, t2=TableTwo, t3=TableThree):
+from connection_pool import pooled_session
+from instrumentation import span, traced
+from query_cache import cached_read_sql
+from schema import apply_schema, register_categories
+
+def rates_statement(t1=TableOne, rate_types=('Fixed',), output_attrs=None):
+    """
+    Build the SQL query for the rates lookup.
+
+    Parameters:
+    - t1 (SQLAlchemy Table): TableOne.
+    - rate_types (list): The rate types to select, e.g. ['Fixed', 'Floating']. None selects every rate type.
+    - output_attrs (list): The output attributes to select. None selects every output attribute.
+
+    Returns:
+    - stmt (SQLAlchemy Select): The rates query.
+    """
+    conditions = [t1.time.in_(time_range)]
+    if rate_types is not None:
+        conditions.append(t1.rate_type.in_(rate_types))
+    if output_attrs is not None:
+        conditions.append(t1.output_attr.in_(output_attrs))
+    return select([t1.time, t1.input_attr, t1.output_attr, t1.rate, t1.rate_type]).where(*conditions)
+
+def convert_measures(data_df, rates_df):
+    """
+    Join the rates lookup to the data and compute the converted measures for every rate type at once.
+
+    Each data row is repeated for every rate of its time and attribute, as the SQL join did, and rows
+    without a rate are dropped.
+
+    Parameters:
+    - data_df (pandas.DataFrame): The data without rates.
+    - rates_df (pandas.DataFrame): The rates lookup from rates_statement.
+
+    Returns:
+    - data_df (pandas.DataFrame): The data with rate, rate_type, output_attr and the converted measures.
+    """
+    rates_df = rates_df.dropna(subset=['time', 'input_attr'])
+    data_df = data_df.merge(rates_df, left_on=['time', 'attribute'], right_on=['time', 'input_attr'], how='inner')
+
+    measure2 = data_df['measure2'].to_numpy()
+    computed_measure1 = measure2 / data_df['rate'].to_numpy()
+    data_df['computed_measure1'] = computed_measure1
+    data_df['computed_measure3'] = computed_measure1 / data_df['measure3'].to_numpy()
+    return data_df
+
+@traced('data_pull.data_export')
+def data_export(t1=TableOne, t2=TableTwo, t3=TableThree, use_cache=False, rate_types=('Fixed',), output_attrs=None):
     """
     Export the basic data from the database into a dataframe.
     It connects to the database, selects certain columns from joined tables, and manipulates the resulting dataframe.
+
+    The data rows are pulled once, without the rates. The rates are pulled as a small lookup and joined in
+    pandas, so several rate types or output attributes cost one pass over the data. The result has one row
+    per data row and rate, with the rate_type and output_attr columns telling the rates apart.
     
     Parameters:
     - t1 (SQLAlchemy Table): TableOne.
     - t2 (SQLAlchemy Table): TableTwo.
     - t3 (SQLAlchemy Table): TableThree.
+    - use_cache (bool): If True, the data rows are loaded from the local query cache while the max update_time
+      of TableTwo is unchanged since the cached pull. The rates are always read from the database.
+    - rate_types (list): The rate types to convert with, e.g. ['Fixed', 'Floating']. None converts with every rate type.
+    - output_attrs (list): The output attributes to convert to. None converts to every output attribute.
     
     Returns:
     - data_df (pandas.DataFrame): DataFrame with selected data for specified categories and date range.
     """
 
-    session = establish_connection()
+    session = pooled_session()
 
-    print("Building SQL query for data...")
     stmt = select([
         t2.category,
         t2.attribute,
         t3.region,  
         t2.time, 
         t2.measure1,
-        t1.rate,
         t2.measure2,
-        label('computed_measure1', t2.measure2 / t1.rate),
         label('computed_measure2', t2.measure2 / t2.measure3),
-        label('computed_measure3', (t2.measure2 / t1.rate) / t2.measure3),
         t2.measure3,
         t2.measure4,
         t2.measure5,
         t2.measure6,
-        t1.rate_type,
-        t1.output_attr,
         t2.update_time,
         label('last_db_pull', func.current_date())
     ]).select_from(
         t2.__table__
-        .join(t1.__table__, (t2.time == t1.time) & (t2.attribute == t1.input_attr))
         .join(t3.__table__, t2.category == t3.category)
     ).where(
-        t1.rate_type == 'Fixed',
         t2.time.in_(time_range),
         t2.category.in_(categories)
     )
     
-    print("Executing SQL query for data and loading the results into a dataframe...")
-    data_df = pd.read_sql(stmt, session.bind)
+    with span('data_pull.load', "Executing SQL query for data and loading the results into a dataframe...",
+              cached=use_cache) as s:
+        if use_cache:
+            data_df = cached_read_sql(stmt, session.bind,
+                                      params={'time_range': time_range, 'categories': categories},
+                                      watermark_stmt=select([func.max(t2.update_time)]))
+        else:
+            data_df = pd.read_sql(stmt, session.bind)
+        s.frame_out(data_df)
+
+    with span('data_pull.load_rates', "Loading the rates...", rate_types=rate_types) as s:
+        rates_df = pd.read_sql(rates_statement(t1, rate_types, output_attrs), session.bind)
+        s.frame_out(rates_df)
 
-    print("Closing database connection...")
     session.close()
 
-    data_df = clean_timestamps(data_df)
+    with span('data_pull.transform') as s:
+        s.frame_in(data_df)
+        data_df = convert_measures(data_df, rates_df)
+        data_df = clean_timestamps(data_df)
+
+        data_df = data_df[['date','time','region','category','attribute','year','quarter',
+                     'measure1','computed_measure2','computed_measure3','measure2','computed_measure1','measure3','measure4',
+                     'measure5','measure6','rate','rate_type',
+                     'output_attr','update_time','last_db_pull']]
+        data_df.sort_values(['category','date'], inplace=True)
+        data_df.reset_index(drop=True, inplace=True)  # reset the index to start at 0
+        s.frame_out(data_df)
 
-    data_df = data_df[['date','time','region','category','attribute','year','quarter',
-                 'measure1','computed_measure2','computed_measure3','measure2','computed_measure1','measure3','measure4',
-                 'measure5','measure6','rate','rate_type',
-                 'output_attr','update_time','last_db_pull']]
-    data_df.sort_values(['category','date'], inplace=True)
-    data_df.reset_index(drop=True, inplace=True)  # reset the index to start at 0
+    # Shared categorical dtypes for the identifier columns
+    register_categories('category', categories)
+    data_df = apply_schema(data_df, 'data_pull.data_export')
 
     print("Data dataframe export complete.")
     print("")
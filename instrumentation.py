@@ -0,0 +1,264 @@
+"""
+This module records named spans around the query, load, transform, fit and save phases of the pipeline,
+so it can be seen where the time and memory of a run go.
+
+A span replaces a progress print: the message is still printed, and when tracing is enabled the span also records
+its duration, the rows going in and out, the bytes of the frames it loaded and the peak RSS of the process.
+Tracing is disabled by default, in which case span only prints the message and returns a shared no-op span.
+
+Tracing is enabled with enable_tracing() or by setting the PIPELINE_TRACE environment variable, to 1 to keep
+the records in memory or to the path of a JSON lines file that every finished span is appended to. Worker
+processes inherit the environment variable, so their spans are written to the same file.
+
+Usage:
+------
+with span('data_pull.load', "Executing SQL query for data...") as s:
+    data_df = pd.read_sql(stmt, session.bind)
+    s.frame_out(data_df)
+
+Functions:
+----------
+enable_tracing(log_path=None): starts recording spans
+disable_tracing(): stops recording spans
+tracing_enabled(): whether spans are recorded
+span(name, message=None, **attrs): a context manager that times one phase
+traced(name): a decorator that wraps every call of a function in a span
+span_records(): the records of the finished spans of this process
+summary_report(records=None): aggregates the records per span name and prints a table
+reset_tracing(): clears the records of this process
+"""
+
+import json
+import os
+import sys
+import threading
+import time
+from functools import wraps
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+_trace_setting = os.environ.get('PIPELINE_TRACE', '')
+_enabled = _trace_setting not in ('', '0')
+_log_path = _trace_setting if _enabled and _trace_setting != '1' else None
+_records = []
+_lock = threading.Lock()
+_local = threading.local()
+
+def enable_tracing(log_path=None):
+    """
+    Starts recording spans.
+
+    Parameters:
+    - log_path (str): A JSON lines file that every finished span is appended to. The records are also kept in memory.
+    """
+    global _enabled, _log_path
+    _enabled = True
+    _log_path = log_path
+    # Worker processes started from here inherit the setting
+    os.environ['PIPELINE_TRACE'] = log_path or '1'
+
+def disable_tracing():
+    """
+    Stops recording spans. The records so far are kept.
+    """
+    global _enabled, _log_path
+    _enabled = False
+    _log_path = None
+    os.environ.pop('PIPELINE_TRACE', None)
+
+def tracing_enabled():
+    return _enabled
+
+def reset_tracing():
+    with _lock:
+        _records.clear()
+
+def span_records():
+    """
+    Returns the records of the finished spans of this process, in the order they finished.
+    """
+    with _lock:
+        return list(_records)
+
+def _peak_rss_mb():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+    return round(peak / 2**20 if sys.platform == 'darwin' else peak / 2**10, 1)
+
+def _frame_bytes(frame):
+    """
+    The in-memory size of a dataframe, including the strings of object columns, as a proxy for the bytes loaded.
+    """
+    try:
+        return int(frame.memory_usage(index=True, deep=True).sum())
+    except AttributeError:
+        return None
+
+class _NullSpan:
+    """
+    The span returned while tracing is disabled. Every method does nothing.
+    """
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+    def set(self, **attrs):
+        pass
+
+    def frame_in(self, frame):
+        pass
+
+    def frame_out(self, frame):
+        pass
+
+_null_span = _NullSpan()
+
+class Span:
+    """
+    A recorded span. Use span() rather than creating it directly.
+    """
+    __slots__ = ('name', 'attrs', 'parent', 'start')
+
+    def __init__(self, name, attrs):
+        self.name = name
+        self.attrs = attrs
+
+    def __enter__(self):
+        stack = getattr(_local, 'stack', None)
+        if stack is None:
+            stack = _local.stack = []
+        self.parent = stack[-1].name if stack else None
+        stack.append(self)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        seconds = time.perf_counter() - self.start
+        _local.stack.pop()
+        record = {
+            'span': self.name,
+            'parent': self.parent,
+            'seconds': round(seconds, 6),
+            'peak_rss_mb': _peak_rss_mb(),
+            'pid': os.getpid(),
+            'thread': threading.current_thread().name,
+            'status': 'error' if exc_type is not None else 'ok'
+        }
+        if exc_type is not None:
+            record['error'] = exc_type.__name__
+        record.update(self.attrs)
+
+        with _lock:
+            _records.append(record)
+            if _log_path:
+                with open(_log_path, 'a') as f:
+                    f.write(json.dumps(record, default=str) + '\n')
+        return False
+
+    def set(self, **attrs):
+        """
+        Adds attributes to the record, e.g. rows_out=len(df) or region=region.
+        """
+        self.attrs.update(attrs)
+
+    def frame_in(self, frame):
+        """
+        Records the rows of the dataframe going into the span.
+        """
+        self.attrs['rows_in'] = len(frame)
+
+    def frame_out(self, frame):
+        """
+        Records the rows and bytes of the dataframe coming out of the span.
+        """
+        self.attrs['rows_out'] = len(frame)
+        self.attrs['bytes_out'] = _frame_bytes(frame)
+
+def span(name, message=None, **attrs):
+    """
+    Times one phase of the pipeline.
+
+    Parameters:
+    - name (str): The name of the span, '<module>.<phase>' by convention, e.g. 'data_export.load'.
+    - message (str): A progress message, printed whether or not tracing is enabled.
+    - attrs: Extra attributes to record, e.g. region=region.
+
+    Returns:
+    - span (context manager): A Span while tracing is enabled and a shared no-op span otherwise.
+    """
+    if message is not None:
+        print(message)
+    if not _enabled:
+        return _null_span
+    return Span(name, attrs)
+
+def traced(name):
+    """
+    Wraps every call of the decorated function in a span with the given name.
+    If the function returns a dataframe, its rows and bytes are recorded.
+    """
+    def decorator(function):
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return function(*args, **kwargs)
+            with Span(name, {}) as s:
+                result = function(*args, **kwargs)
+                if hasattr(result, 'memory_usage'):
+                    s.frame_out(result)
+                return result
+        return wrapper
+    return decorator
+
+def summary_report(records=None, log_path=None):
+    """
+    Aggregates the span records per span name and prints a table, slowest total first.
+
+    Parameters:
+    - records (list): The records to summarize. Defaults to span_records(), or the records in log_path if given.
+    - log_path (str): A JSON lines file written while tracing, e.g. one that collected the spans of worker processes.
+
+    Returns:
+    - summary (list): A dict per span name with the calls, total, mean and max seconds, total rows out,
+      total bytes out, max peak RSS and errors.
+    """
+    if records is None:
+        if log_path:
+            with open(log_path) as f:
+                records = [json.loads(line) for line in f if line.strip()]
+        else:
+            records = span_records()
+
+    summary = {}
+    for record in records:
+        entry = summary.setdefault(record['span'], {
+            'span': record['span'], 'calls': 0, 'total_seconds': 0.0, 'max_seconds': 0.0,
+            'rows_out': 0, 'bytes_out': 0, 'peak_rss_mb': None, 'errors': 0
+        })
+        entry['calls'] += 1
+        entry['total_seconds'] += record['seconds']
+        entry['max_seconds'] = max(entry['max_seconds'], record['seconds'])
+        entry['rows_out'] += record.get('rows_out') or 0
+        entry['bytes_out'] += record.get('bytes_out') or 0
+        entry['errors'] += record['status'] == 'error'
+        if record.get('peak_rss_mb') is not None:
+            entry['peak_rss_mb'] = max(entry['peak_rss_mb'] or 0, record['peak_rss_mb'])
+
+    summary = sorted(summary.values(), key=lambda entry: entry['total_seconds'], reverse=True)
+    for entry in summary:
+        entry['mean_seconds'] = entry['total_seconds'] / entry['calls']
+
+    print(f"{'span':<36}{'calls':>7}{'total s':>10}{'mean s':>10}{'rows out':>12}{'MB out':>9}{'peak RSS MB':>13}")
+    for entry in summary:
+        print(f"{entry['span']:<36}{entry['calls']:>7}{entry['total_seconds']:>10.3f}{entry['mean_seconds']:>10.3f}"
+              f"{entry['rows_out']:>12,}{entry['bytes_out'] / 2**20:>9.1f}{entry['peak_rss_mb'] or 0:>13.1f}")
+    return summary
@@ -6,19 +6,42 @@ It fits the other parameters to produce a projection out to a specified future d
 
 Functions:
 ----------
-extract_user_data(): exports the user data from the database
+extract_user_data(source='pandas'): exports the user data from the database
 set_global_variables(df, region): sets the global variables for the regional forecast
-forecast_for_region(view, ceilings, end_date, region): produces the forecast for a given region
+logistic_initial_guess(x, y, L): estimates starting values for (k, x0) from the data of each series
+fit_logistic_batch(x, y, L, p0=None): fits (k, x0) for many series at once in one vectorized solve
+forecast_for_region(view, ceilings, end_date, region, params=None): produces the forecast for a given region
 forecast_for_specific_region(df, region, ceilings): produces the forecast for a given region and outputs to a dataframe
+region_fingerprint(view, L): fingerprints the input data and ceiling of a region
+load_parameter_cache(path): loads the fitted parameters of the previous run
+save_parameter_cache(cache, path): saves the fitted parameters for the next run
+forecast_all_services(df, forecast_regions, ceilings, services=service_columns): produces the forecast for every service in every region
+parameter_table(forecast): collapses a forecast to one row of logistic parameters per region (and service)
+render_formulas(forecast, parameters=None): renders the logistic formula of each forecast row as text, on demand
+excel_formulas(forecast, parameters, parameter_sheet, t_column): builds native Excel formulas that reference the parameter cells
+ceiling_grid(forecast_regions, ceilings, low=0.8, high=1.2, n_scenarios=101): builds ceiling scenarios around the hand-set ceilings
+forecast_ceiling_scenarios(df, forecast_regions, scenario_ceilings): fits and evaluates every region under many ceilings in one pass
+scenario_frame(scenarios): flattens the scenario forecasts into one long dataframe, on demand
+add_prediction_intervals(forecast, method='residual', n_boot=1000, seed=0): adds bootstrap P10/P50/P90 columns to the forecast
+main(parallel=False, workers=None, fit_method='curve_fit', cache_path=None, all_services=False, source='pandas', scenario_ceilings=None, intervals=None, n_boot=1000, seed=0): produces the forecast for every region
 
 Module imports:
 ---------------
 utils.database_export_funcs.data_export: exports the user data from the database
 utils.database_export_funcs.get_sample_sizes: exports the sample sizes from the database
+data_extract_common_table_expressions.get_user_counts: counts the users of each service per group in the database
 utils.functions.create_date_range: creates a date range from the start to the end of the forecast
 utils.config.user_data_ceilings: contains the long-term carrying capacities for each region
+instrumentation: times the load, fit and save phases
+schema: shared categorical dtypes for the identifier columns
 """
 
+import hashlib
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+
 import pandas as pd
 import numpy as np
 
@@ -28,43 +51,61 @@ from scipy.optimize import curve_fit
 from utils.database_export_funcs import data_export, get_sample_sizes
 from utils.functions import create_date_range
 from utils.config import user_data_ceilings as ceilings
+from data_extract_common_table_expressions import get_user_counts
+from instrumentation import span, traced
+from schema import apply_schema, register_categories
 
 regions = list(ceilings.keys())
 
 skipped_regions = ['Region_A','Region_B','Region_C','Region_D',
                      'Region_E','Region_F','Region_G','Region_H']
 
-def extract_user_data():
+service_columns = ['service_1', 'service_2','service_3', 'service_4','service_5', 'other_services']
+
+def extract_user_data(source='pandas'):
     """
     Exports user date from the database and calculates the monthly active users for each region.
 
+    Parameters
+    ----------
+    source : str
+        'pandas' exports the respondent-level data and counts the users in pandas.
+        'sql' counts the users in the database with get_user_counts, so only one row per
+        (date, area, region) is transferred. Both sources take the sample sizes from get_sample_sizes.
+
     Returns
     -------
     pandas.DataFrame with monthly active users over time for each region.
     """
 
-    print("Preparing the data for the user activity forecast...")
-    df = data_export()
-    sample_sizes = get_sample_sizes()
-    sample_sizes.set_index(['date','region'], inplace=True)
+    if source not in ('sql', 'pandas'):
+        raise ValueError(f"Unknown user data source '{source}'. Use 'pandas' or 'sql'.")
+
+    with span('monthly_user_forecast.load', "Preparing the data for the user activity forecast...", source=source) as s:
+        if source == 'sql':
+            user_count = get_user_counts(services=service_columns)
+        else:
+            df = data_export()
+            s.frame_in(df)
 
-    mau = df[['date','area','region','service_1', 'service_2',
-        'service_3', 'service_4',
-        'service_5', 'other_services']]
+            mau = df[['date','area','region'] + service_columns]
 
-    # Get the total number of users who have used at least one service
-    user_count = mau.replace(0, np.nan)  # Replace 0 with np.nan to ignore 0s in the count
-    user_count = user_count.groupby(['date','area','region']).count().reset_index()
-    user_count = user_count.set_index(['date','region'])
+            # Get the total number of users who have used at least one service
+            user_count = mau.replace(0, np.nan)  # Replace 0 with np.nan to ignore 0s in the count
+            user_count = user_count.groupby(['date','area','region']).count().reset_index()
 
-    # Add the sample sizes to user_count
-    user_count['sample_size'] = sample_sizes['sample_size']
-    user_count.reset_index(inplace=True)
+        sample_sizes = get_sample_sizes()
+        sample_sizes.set_index(['date','region'], inplace=True)
+        user_count = user_count.set_index(['date','region'])
+
+        # Add the sample sizes to user_count
+        user_count['sample_size'] = sample_sizes['sample_size']
+        user_count.reset_index(inplace=True)
+        s.frame_out(user_count)
 
     mau_activity = user_count.copy()
 
-    columns = ['service_1', 'service_2','service_3', 'service_4','service_5', 'other_services']
-    for col in columns:
+    for col in service_columns:
         mau_activity[col] = mau_activity[col] / mau_activity['sample_size']
     mau_activity['forecast_flag'] = 'A'
 
@@ -74,7 +115,9 @@ def extract_user_data():
     jitter = 1e-6
     mau_activity['service_1'] = mau_activity['service_1'] + jitter
 
-    return mau_activity
+    # Shared categorical dtypes for the identifier columns
+    register_categories('region', regions)
+    return apply_schema(mau_activity, 'extract_user_data')
 
 def set_global_variables(df, region):
     """
@@ -120,7 +163,181 @@ def set_global_variables(df, region):
 
     return view, end_date, min_date
 
-def forecast_for_region(view, ceilings, end_date, region):
+def _stack_series(series):
+    """
+    Stacks a list of 1-D arrays of unequal length into a 2-D array padded with NaN.
+    """
+    width = max((len(s) for s in series), default=0)
+    stacked = np.full((len(series), width), np.nan)
+    for i, s in enumerate(series):
+        stacked[i, :len(s)] = s
+    return stacked
+
+def logistic_initial_guess(x, y, L):
+    """
+    Estimates starting values for (k, x0) from the data of each series.
+
+    The fixed-ceiling logistic is linear after a logit transform, log(y / (L - y)) = k * t - k * x0,
+    so an ordinary least squares line through the transformed points gives the starting values.
+
+    Parameters
+    ----------
+    x : numpy.ndarray
+        The date_num values, shape (n_series, n_obs), padded with NaN.
+    y : numpy.ndarray
+        The observed values, shape (n_series, n_obs), padded with NaN.
+    L : numpy.ndarray
+        The ceiling of each series, shape (n_series,).
+
+    Returns
+    -------
+    numpy.ndarray
+        The starting values, shape (n_series, 2), with columns k and x0.
+    """
+    L = L[:, np.newaxis]
+    usable = np.isfinite(x) & np.isfinite(y) & (y > 0) & (y < L)
+    ratio = np.where(usable, y, 0.5 * L) / np.where(usable, L - y, 0.5 * L)
+    z = np.where(usable, np.log(ratio), 0.0)
+    t = np.where(usable, x, 0.0)
+
+    n = usable.sum(axis=1)
+    t_mean = t.sum(axis=1) / np.maximum(n, 1)
+    z_mean = z.sum(axis=1) / np.maximum(n, 1)
+    t_dev = np.where(usable, t - t_mean[:, np.newaxis], 0.0)
+    z_dev = np.where(usable, z - z_mean[:, np.newaxis], 0.0)
+    sxx = (t_dev ** 2).sum(axis=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        k = (t_dev * z_dev).sum(axis=1) / sxx
+        x0 = t_mean - z_mean / k
+
+    # Fall back to a gentle curve centred on the data when the regression is not usable
+    x_span = np.nanmax(np.where(np.isfinite(x), x, np.nan), axis=1) if x.size else np.zeros(len(L))
+    x_span = np.where(np.isfinite(x_span) & (x_span > 0), x_span, 1.0)
+    fallback = (n < 2) | ~np.isfinite(k) | ~np.isfinite(x0) | (k <= 0)
+    k = np.where(fallback, 4.0 / x_span, k)
+    x0 = np.where(fallback, x_span / 2, x0)
+    return np.column_stack([k, x0])
+
+def fit_logistic_batch(x, y, L, p0=None, max_iter=500, tol=1.49012e-08):
+    """
+    Fits the growth rate k and midpoint x0 of the fixed-ceiling logistic L / (1 + exp(-k * (t - x0)))
+    for many series at once.
+
+    Every series is solved in the same Levenberg-Marquardt iteration using stacked NumPy arrays
+    and the analytic Jacobian, so a full refresh is one vectorized solve instead of one optimizer run per series.
+
+    Parameters
+    ----------
+    x : numpy.ndarray
+        The date_num values, shape (n_series, n_obs), padded with NaN.
+    y : numpy.ndarray
+        The observed values, shape (n_series, n_obs), padded with NaN.
+    L : numpy.ndarray
+        The ceiling of each series, shape (n_series,).
+    p0 : numpy.ndarray, optional
+        Starting values for (k, x0), shape (n_series, 2). Estimated from the data when not given.
+    max_iter : int
+        The maximum number of iterations.
+    tol : float
+        The relative change in the sum of squared residuals, or in the parameters, below which a series has converged.
+        The default matches the ftol and xtol of curve_fit.
+
+    Returns
+    -------
+    params : numpy.ndarray
+        The fitted (k, x0) of each series, shape (n_series, 2).
+    cov : numpy.ndarray
+        The estimated covariance of (k, x0) of each series, shape (n_series, 2, 2), scaled like curve_fit.
+    success : numpy.ndarray
+        Whether each series converged to finite parameters, shape (n_series,).
+    """
+    x = np.atleast_2d(np.asarray(x, dtype=float))
+    y = np.atleast_2d(np.asarray(y, dtype=float))
+    L = np.broadcast_to(np.asarray(L, dtype=float), (x.shape[0],))
+    observed = np.isfinite(x) & np.isfinite(y)
+    t = np.where(observed, x, 0.0)
+    y = np.where(observed, y, 0.0)
+    Lc = L[:, np.newaxis]
+
+    def residuals_and_jacobian(params, rows):
+        k = params[:, 0:1]
+        x0 = params[:, 1:2]
+        t_rows = t[rows]
+        mask = observed[rows]
+        with np.errstate(over='ignore'):
+            s = 1 / (1 + np.exp(-k * (t_rows - x0)))
+        residuals = np.where(mask, y[rows] - Lc[rows] * s, 0.0)
+        slope = np.where(mask, Lc[rows] * s * (1 - s), 0.0)
+        jac_k = slope * (t_rows - x0)
+        jac_x0 = -slope * k
+        return residuals, jac_k, jac_x0
+
+    all_rows = np.arange(x.shape[0])
+    params = logistic_initial_guess(x, y, L) if p0 is None else np.array(p0, dtype=float, copy=True)
+    residuals, jac_k, jac_x0 = residuals_and_jacobian(params, all_rows)
+    sse = (residuals ** 2).sum(axis=1)
+    damping = np.full(len(params), 1e-3)
+    converged = np.zeros(len(params), dtype=bool)
+    active = all_rows[np.isfinite(sse)]
+
+    for _ in range(max_iter):
+        if not active.size:
+            break
+
+        # Damped normal equations (J'J + lambda * diag(J'J)) delta = J'r, solved in closed form per series.
+        # Only the series that are still iterating are evaluated.
+        J_k, J_x0, r = jac_k[active], jac_x0[active], residuals[active]
+        a = (J_k ** 2).sum(axis=1)
+        b = (J_k * J_x0).sum(axis=1)
+        d = (J_x0 ** 2).sum(axis=1)
+        g_k = (J_k * r).sum(axis=1)
+        g_x0 = (J_x0 * r).sum(axis=1)
+        with np.errstate(over='ignore', divide='ignore', invalid='ignore'):
+            a_damped = a * (1 + damping[active])
+            d_damped = d * (1 + damping[active])
+            det = a_damped * d_damped - b ** 2
+            step = np.column_stack([(d_damped * g_k - b * g_x0) / det,
+                                    (a_damped * g_x0 - b * g_k) / det])
+        step[~np.isfinite(step).all(axis=1)] = 0.0
+
+        trial = params[active] + step
+        trial_residuals, trial_jac_k, trial_jac_x0 = residuals_and_jacobian(trial, active)
+        trial_sse = (trial_residuals ** 2).sum(axis=1)
+
+        current_sse = sse[active]
+        improved = np.isfinite(trial_sse) & (trial_sse < current_sse)
+        change = np.where(improved, (current_sse - trial_sse) / np.maximum(current_sse, np.finfo(float).tiny), 0.0)
+        current_params = params[active]
+        step_size = np.abs(step / np.where(current_params == 0, 1.0, current_params)).max(axis=1)
+
+        moved = active[improved]
+        params[moved] = trial[improved]
+        residuals[moved] = trial_residuals[improved]
+        jac_k[moved] = trial_jac_k[improved]
+        jac_x0[moved] = trial_jac_x0[improved]
+        sse[moved] = trial_sse[improved]
+        damping[active] = np.where(improved, damping[active] / 10, damping[active] * 10)
+
+        # A series has converged once it stops improving or can no longer take a useful step
+        done = (improved & ((change < tol) | (step_size < tol))) | (damping[active] > 1e12) | (sse[active] == 0)
+        converged[active[done]] = True
+        active = active[~done]
+
+    # Covariance scaled by the residual variance, as curve_fit does with absolute_sigma=False
+    a = (jac_k ** 2).sum(axis=1)
+    b = (jac_k * jac_x0).sum(axis=1)
+    d = (jac_x0 ** 2).sum(axis=1)
+    det = a * d - b ** 2
+    dof = np.maximum(observed.sum(axis=1) - 2, 1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        scale = sse / dof / det
+        cov = np.stack([np.column_stack([d * scale, -b * scale]),
+                        np.column_stack([-b * scale, a * scale])], axis=1)
+
+    success = converged & np.isfinite(params).all(axis=1) & (observed.sum(axis=1) >= 2)
+    return params, cov, success
+
+def forecast_for_region(view, ceilings, end_date, region, params=None):
     """
     This function produces the forecast for a given region.
 
@@ -134,6 +351,8 @@ def forecast_for_region(view, ceilings, end_date, region):
         The end date of the forecast.
     region : str
         The region to forecast.
+    params : sequence, optional
+        Already fitted (k, x0), e.g. from fit_logistic_batch. The region is fitted with curve_fit when not given.
 
     Returns
     -------
@@ -147,12 +366,10 @@ def forecast_for_region(view, ceilings, end_date, region):
             - k
             - x0
             - t
-            - formula
     """
 
     region = region
     ceilings = ceilings
-    print(f"Building the forecast for {region}...")
 
     x = view['date_num']
     y = view['service_1']
@@ -171,11 +388,15 @@ def forecast_for_region(view, ceilings, end_date, region):
         return L / (1 + np.exp(-k * (t - x0)))
 
     # Use curve_fit to find the best fit parameters
-    try:
-        params, cov = curve_fit(logistic, x, y, p0=initial_guess)
-    except RuntimeError:
-        print(f"Failed to fit the data for {region} with a logistic model.")
-        params = [0, 0]
+    if params is None:
+        with span('monthly_user_forecast.fit', f"Building the forecast for {region}...", region=region,
+                  method='curve_fit') as s:
+            try:
+                params, cov = curve_fit(logistic, x, y, p0=initial_guess)
+            except RuntimeError:
+                print(f"Failed to fit the data for {region} with a logistic model.")
+                params = [0, 0]
+                s.set(fit_failed=True)
 
     # Create the forecast using the logistic function
     view['forecast'] = logistic(view['date_num'], *params)
@@ -198,9 +419,9 @@ def forecast_for_region(view, ceilings, end_date, region):
     forecast = pd.concat([view, date_range])
     forecast = forecast[['date', 'region', 'service_1', 'forecast', 'forecast_flag', 'L', 'k', 'x0']]
 
-    # Calculate the formula for the logistic function
+    # Days since the start of the forecast, the t of the logistic function
+    # The formula itself is rendered on demand with render_formulas or excel_formulas
     forecast['t'] = (forecast['date'] - forecast['date'].min()).dt.days
-    forecast['formula'] = forecast['L'].map(str) + ' / (1 + exp(-' + forecast['k'].map(str) + ' * (' + forecast['t'].map(str) + ' - ' + forecast['x0'].map(str) + ')))'
 
     return forecast
 
@@ -230,7 +451,6 @@ def forecast_for_specific_region(df, region, ceilings):
             - k
             - x0
             - t
-            - formula
     """
 
     view, end_date, min_date = set_global_variables(df, region)
@@ -238,14 +458,682 @@ def forecast_for_specific_region(df, region, ceilings):
     forecast = forecast_for_region(view, ceilings, end_date, region)
     return forecast
 
-def main():
-    df = extract_user_data()
-    forecast_df = pd.DataFrame()
+def region_fingerprint(view, L):
+    """
+    This function fingerprints the input data and ceiling of a region.
+
+    Parameters
+    ----------
+    view : pandas.DataFrame
+        The prepared data for the region from set_global_variables.
+    L : float
+        The ceiling of the region.
+
+    Returns
+    -------
+    str
+        A hex digest that changes whenever the dates, the values or the ceiling change.
+    """
+    digest = hashlib.sha256()
+    digest.update(view['date'].to_numpy(dtype='datetime64[ns]').tobytes())
+    digest.update(view['service_1'].to_numpy(dtype=float).tobytes())
+    digest.update(repr(float(L)).encode())
+    return digest.hexdigest()
+
+def load_parameter_cache(path):
+    """
+    This function loads the fitted parameters of the previous run.
+
+    Parameters
+    ----------
+    path : str
+        The path of the JSON cache file.
+
+    Returns
+    -------
+    dict
+        The cached fingerprint, L, k, x0 and cov of each region. Empty if there is no cache yet.
+    """
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+def save_parameter_cache(cache, path):
+    """
+    This function saves the fitted parameters for the next run.
+
+    The file is written to a temporary path first, so an interrupted run never leaves a partial cache behind.
+
+    Parameters
+    ----------
+    cache : dict
+        The fingerprint, L, k, x0 and cov of each region.
+    path : str
+        The path of the JSON cache file.
+    """
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    temp_path = path + '.tmp'
+    with open(temp_path, 'w') as f:
+        json.dump(cache, f, indent=2)
+    os.replace(temp_path, path)
+
+def forecast_regions_batched(df, forecast_regions, ceilings, cache_path=None):
+    """
+    This function fits every region in one batched solve and builds the forecast for each of them.
+
+    Parameters
+    ----------
+    df : pandas.DataFrame
+        The monthly active users data from the database.
+    forecast_regions : list
+        The regions to forecast.
+    ceilings : dict
+        The long-term carrying capacities for each region.
+    cache_path : str, optional
+        The path of the parameter cache. Regions whose data and ceiling are unchanged since the last run
+        reuse their cached parameters without fitting, and changed regions start from their previous parameters.
+
+    Returns
+    -------
+    list
+        The forecast dataframe of each region, in the order of forecast_regions.
+    """
+    prepared = [set_global_variables(df, region) for region in forecast_regions]
+    L = np.array([ceilings[region] for region in forecast_regions], dtype=float)
+    params = np.zeros((len(forecast_regions), 2))
+    success = np.zeros(len(forecast_regions), dtype=bool)
+
+    cache = load_parameter_cache(cache_path) if cache_path else {}
+    fingerprints = [region_fingerprint(view, ceiling) for (view, _, _), ceiling in zip(prepared, L)]
+
+    to_fit = []
+    for i, region in enumerate(forecast_regions):
+        cached = cache.get(region)
+        if cached is not None and cached['fingerprint'] == fingerprints[i]:
+            params[i] = [cached['k'], cached['x0']]
+            success[i] = True
+        else:
+            to_fit.append(i)
+
+    if cache_path:
+        print(f"{len(forecast_regions) - len(to_fit)} regions unchanged since the last run, {len(to_fit)} to fit.")
+
+    if to_fit:
+        x = _stack_series([prepared[i][0]['date_num'].to_numpy(dtype=float) for i in to_fit])
+        y = _stack_series([prepared[i][0]['service_1'].to_numpy(dtype=float) for i in to_fit])
+
+        # Warm-start changed regions from their previous parameters, the rest from the data
+        p0 = logistic_initial_guess(x, y, L[to_fit])
+        for row, i in enumerate(to_fit):
+            cached = cache.get(forecast_regions[i])
+            if cached is not None:
+                p0[row] = [cached['k'], cached['x0']]
+
+        with span('monthly_user_forecast.fit', f"Fitting {len(to_fit)} regions in one batch...",
+                  method='batched', series=len(to_fit)) as s:
+            fitted, cov, fitted_ok = fit_logistic_batch(x, y, L[to_fit], p0=p0)
+            s.set(failed=int((~fitted_ok).sum()))
+        params[to_fit] = fitted
+        success[to_fit] = fitted_ok
+
+        for row, i in enumerate(to_fit):
+            if fitted_ok[row]:
+                cache[forecast_regions[i]] = {
+                    'fingerprint': fingerprints[i],
+                    'L': float(L[i]),
+                    'k': float(fitted[row, 0]),
+                    'x0': float(fitted[row, 1]),
+                    'cov': cov[row].tolist()
+                }
+            else:
+                # Failed fits are not cached, so they are retried from the data on the next run
+                cache.pop(forecast_regions[i], None)
+
+        if cache_path:
+            with span('monthly_user_forecast.save'):
+                save_parameter_cache(cache, cache_path)
+
+    forecasts = []
+    for (view, end_date, min_date), region, region_params, ok in zip(prepared, forecast_regions, params, success):
+        if not ok:
+            print(f"Failed to fit the data for {region} with a logistic model.")
+            region_params = [0, 0]
+        forecasts.append(forecast_for_region(view, ceilings, end_date, region, params=region_params))
+    return forecasts
+
+def forecast_all_services(df, forecast_regions, ceilings, services=service_columns):
+    """
+    This function produces the forecast for every service in every region in one pass.
+
+    The data is prepared once per region with set_global_variables, the forecast horizon from create_date_range
+    is computed once, and all (region, service) series are fitted together with fit_logistic_batch.
+
+    Parameters
+    ----------
+    df : pandas.DataFrame
+        The monthly active users data from the database.
+    forecast_regions : list
+        The regions to forecast.
+    ceilings : dict
+        The long-term carrying capacities for each region, shared by all services of the region.
+    services : list
+        The service columns to forecast.
+
+    Returns
+    -------
+    pandas.DataFrame
+        A dataframe with the following columns:
+            - date
+            - region
+            - service
+            - actual
+            - forecast
+            - forecast_flag
+            - L
+            - k
+            - x0
+            - t
+    """
+    prepared = [set_global_variables(df, region) for region in forecast_regions]
+    date_range, time_range = create_date_range()
+    horizon_dates = pd.to_datetime(pd.Series(date_range)).to_numpy()
+    horizon_nums = np.asarray(time_range, dtype=float)
+
+    keys = [(region, service) for region in forecast_regions for service in services]
+    x = _stack_series([view['date_num'].to_numpy(dtype=float) for view, _, _ in prepared for _ in services])
+    y = _stack_series([view[service].to_numpy(dtype=float) for view, _, _ in prepared for service in services])
+    L = np.array([ceilings[region] for region, _ in keys], dtype=float)
+
+    with span('monthly_user_forecast.fit', f"Fitting {len(keys)} region and service combinations in one batch...",
+              method='batched', series=len(keys)) as s:
+        params, cov, success = fit_logistic_batch(x, y, L)
+        s.set(failed=int((~success).sum()))
+    for (region, service), ok in zip(keys, success):
+        if not ok:
+            print(f"Failed to fit the {service} data for {region} with a logistic model.")
+    params[~success] = 0
+
+    frames = []
+    for row, (region, service) in enumerate(keys):
+        view = prepared[row // len(services)][0]
+        k, x0 = params[row]
+        n_actual = len(view)
+
+        dates = np.concatenate([view['date'].to_numpy(dtype='datetime64[ns]'), horizon_dates])
+        date_nums = np.concatenate([view['date_num'].to_numpy(dtype=float), horizon_nums])
+        actual = np.concatenate([view[service].to_numpy(dtype=float), np.full(len(horizon_nums), np.nan)])
+        # As in forecast_for_region, the parameters are only set on the rows with actual data
+        on_actual = np.arange(len(dates)) < n_actual
+
+        frames.append(pd.DataFrame({
+            'date': dates,
+            'region': region,
+            'service': service,
+            'actual': actual,
+            'forecast': L[row] / (1 + np.exp(-k * (date_nums - x0))),
+            'forecast_flag': 'F',
+            'L': np.where(on_actual, L[row], np.nan),
+            'k': np.where(on_actual, k, np.nan),
+            'x0': np.where(on_actual, x0, np.nan),
+            't': (dates - dates.min()).astype('timedelta64[D]').astype(int)
+        }, index=np.concatenate([view.index.to_numpy(), np.arange(len(horizon_nums))])))
+
+    forecast = pd.concat(frames) if frames else pd.DataFrame()
+    return forecast
+
+def ceiling_grid(forecast_regions, ceilings, low=0.8, high=1.2, n_scenarios=101):
+    """
+    This function builds ceiling scenarios by scaling the hand-set ceiling of each region.
+
+    Parameters
+    ----------
+    forecast_regions : list
+        The regions to forecast.
+    ceilings : dict
+        The long-term carrying capacities for each region.
+    low, high : float
+        The smallest and largest factor applied to the ceilings.
+    n_scenarios : int
+        The number of evenly spaced factors from low to high.
+
+    Returns
+    -------
+    numpy.ndarray
+        The ceiling of each scenario and region, shape (n_scenarios, n_regions).
+    """
+    factors = np.linspace(low, high, n_scenarios)
+    base = np.array([ceilings[region] for region in forecast_regions], dtype=float)
+    return factors[:, np.newaxis] * base[np.newaxis, :]
+
+def _scenario_matrix(forecast_regions, scenario_ceilings):
+    """
+    Converts the scenario ceilings to an array of shape (n_scenarios, n_regions).
+    """
+    if isinstance(scenario_ceilings, dict):
+        columns = [np.asarray(scenario_ceilings[region], dtype=float) for region in forecast_regions]
+        if len({len(column) for column in columns}) > 1:
+            raise ValueError("Every region needs the same number of ceiling scenarios.")
+        return np.column_stack(columns)
+
+    L = np.asarray(scenario_ceilings, dtype=float)
+    if L.ndim == 1:
+        # The same ceilings for every region
+        L = np.repeat(L[:, np.newaxis], len(forecast_regions), axis=1)
+    if L.ndim != 2 or L.shape[1] != len(forecast_regions):
+        raise ValueError(f"Expected scenario ceilings of shape (n_scenarios, {len(forecast_regions)}), got {L.shape}.")
+    return L
+
+def forecast_ceiling_scenarios(df, forecast_regions, scenario_ceilings, dtype=np.float32):
+    """
+    This function fits and evaluates the forecast of every region under many alternative ceilings at once.
+
+    The data of each region is prepared once, and the (k, x0) of every scenario and region are fitted together
+    in a single fit_logistic_batch solve. The curves are evaluated over the create_date_range horizon with one
+    broadcast expression.
+
+    Parameters
+    ----------
+    df : pandas.DataFrame
+        The monthly active users data from the database.
+    forecast_regions : list
+        The regions to forecast.
+    scenario_ceilings : numpy.ndarray or dict
+        The ceilings to try, either an array of shape (n_scenarios, n_regions), e.g. from ceiling_grid or
+        drawn from a distribution, a 1-D array of ceilings shared by every region, or a dict with the
+        sequence of ceilings of each region.
+    dtype : numpy.dtype
+        The dtype of the evaluated forecasts.
+
+    Returns
+    -------
+    dict
+        - regions : the regions, the second axis of the arrays
+        - dates : the horizon dates from create_date_range, the last axis of forecast
+        - L, k, x0 : the ceiling and fitted parameters, shape (n_scenarios, n_regions)
+        - success : whether each fit converged, shape (n_scenarios, n_regions)
+        - forecast : the forecast of each scenario, region and date, shape (n_scenarios, n_regions, n_dates),
+          NaN where the fit failed
+    """
+    L = _scenario_matrix(forecast_regions, scenario_ceilings)
+    n_scenarios, n_regions = L.shape
+
+    prepared = [set_global_variables(df, region) for region in forecast_regions]
+    x = _stack_series([view['date_num'].to_numpy(dtype=float) for view, _, _ in prepared])
+    y = _stack_series([view['service_1'].to_numpy(dtype=float) for view, _, _ in prepared])
+
+    # Scenario-major rows: row s * n_regions + r is scenario s of region r
+    with span('monthly_user_forecast.fit', f"Fitting {n_scenarios} ceiling scenarios for {n_regions} regions in one batch...",
+              method='batched', series=L.size) as s:
+        params, cov, success = fit_logistic_batch(np.tile(x, (n_scenarios, 1)), np.tile(y, (n_scenarios, 1)), L.ravel())
+        s.set(failed=int((~success).sum()))
+    params = params.reshape(n_scenarios, n_regions, 2)
+    success = success.reshape(n_scenarios, n_regions)
+
+    date_range, time_range = create_date_range()
+    t = np.asarray(time_range, dtype=float)
+    k = params[:, :, 0]
+    x0 = params[:, :, 1]
+    with np.errstate(over='ignore', invalid='ignore'):
+        forecast = (L[:, :, np.newaxis] / (1 + np.exp(-k[:, :, np.newaxis] * (t - x0[:, :, np.newaxis])))).astype(dtype)
+    forecast[~success] = np.nan
+
+    return {
+        'regions': list(forecast_regions),
+        'dates': pd.DatetimeIndex(pd.to_datetime(pd.Series(date_range))),
+        'L': L,
+        'k': k,
+        'x0': x0,
+        'success': success,
+        'forecast': forecast
+    }
+
+def scenario_frame(scenarios):
+    """
+    This function flattens the output of forecast_ceiling_scenarios into one long dataframe, on demand.
+
+    Returns
+    -------
+    pandas.DataFrame
+        A dataframe with one row per scenario, region and date and the following columns:
+            - scenario
+            - region (categorical)
+            - date
+            - L
+            - forecast
+    """
+    n_scenarios, n_regions, n_dates = scenarios['forecast'].shape
+    scenario, region, date = np.indices((n_scenarios, n_regions, n_dates)).reshape(3, -1)
+    return pd.DataFrame({
+        'scenario': scenario,
+        'region': pd.Categorical.from_codes(region, categories=scenarios['regions']),
+        'date': scenarios['dates'][date],
+        'L': scenarios['L'][scenario, region],
+        'forecast': scenarios['forecast'].reshape(-1)
+    })
+
+def _bootstrap_batch(x, fitted, residuals, L, params, cov, t_eval, method, n_draws, seed):
+    """
+    Draws n_draws resampled forecasts of every region, for one batch of add_prediction_intervals.
+
+    Returns the resampled curves and the resampled noise, both shape (n_draws, n_regions, n_eval).
+    The curves are NaN where a resampled fit failed.
+    """
+    rng = np.random.default_rng(seed)
+    n_regions, n_obs = x.shape
+    observed = np.isfinite(x) & np.isfinite(residuals)
+    counts = observed.sum(axis=1)
+    # The residuals of each region moved to the front of its row, so they can be drawn by position
+    pool = _stack_series([residuals[r][observed[r]] for r in range(n_regions)])
+    rows = np.arange(n_regions)[np.newaxis, :, np.newaxis]
+
+    def draw_residuals(width):
+        positions = (rng.random((n_draws, n_regions, width)) * np.maximum(counts, 1)[np.newaxis, :, np.newaxis]).astype(int)
+        return pool[rows, positions]
+
+    if method == 'residual':
+        # Refit every region to its fitted curve plus resampled residuals
+        y_star = np.where(observed, fitted + draw_residuals(n_obs), np.nan)
+        draws, _, ok = fit_logistic_batch(np.tile(x, (n_draws, 1)), y_star.reshape(-1, n_obs), np.tile(L, n_draws),
+                                          p0=np.tile(params, (n_draws, 1)))
+        draws = draws.reshape(n_draws, n_regions, 2)
+        draws[~ok.reshape(n_draws, n_regions)] = np.nan
+        noise = draw_residuals(t_eval.shape[1])
+    else:
+        # Draw the parameters from the normal approximation given by the fit covariance
+        # Cholesky factor of each 2x2 covariance, clipped so rounding cannot make it fail
+        cov = np.where(np.isfinite(cov), cov, 0.0)
+        l11 = np.sqrt(np.maximum(cov[:, 0, 0], 0.0))
+        l21 = np.divide(cov[:, 1, 0], l11, out=np.zeros(n_regions), where=l11 > 0)
+        l22 = np.sqrt(np.maximum(cov[:, 1, 1] - l21 ** 2, 0.0))
+        z = rng.standard_normal((n_draws, n_regions, 2))
+        draws = params[np.newaxis] + np.stack([l11 * z[:, :, 0], l21 * z[:, :, 0] + l22 * z[:, :, 1]], axis=2)
+        sigma = np.sqrt((np.where(observed, residuals, 0.0) ** 2).sum(axis=1) / np.maximum(counts - 2, 1))
+        noise = rng.standard_normal((n_draws, n_regions, t_eval.shape[1])) * sigma[np.newaxis, :, np.newaxis]
+
+    k = draws[:, :, 0:1]
+    x0 = draws[:, :, 1:2]
+    with np.errstate(over='ignore', invalid='ignore'):
+        return L[np.newaxis, :, np.newaxis] / (1 + np.exp(-k * (t_eval[np.newaxis] - x0))), noise
+
+def add_prediction_intervals(forecast, method='residual', n_boot=1000, seed=0, quantiles=(0.1, 0.5, 0.9),
+                             parallel=False, workers=None, batch_size=100):
+    """
+    This function adds prediction interval columns to the regional forecast.
+
+    Each region is refitted to resampled data, or its parameters are drawn from the fit covariance, and the
+    resampled curves plus resampled noise are evaluated on every row of the forecast. The resampled curves are
+    centred on the point forecast, so the bands measure the spread around it rather than the drift of the
+    resampled fits, and the draws are clipped to [0, L] before the quantiles are taken. The draws are made in
+    batches with their own seeds spawned from seed, so the result is the same with or without parallel workers.
+
+    A region whose fit covariance is not positive definite, e.g. a curve_fit step function with a vanishing
+    Jacobian, has no usable spread and gets NaN bands.
+
+    Parameters
+    ----------
+    forecast : pandas.DataFrame
+        The forecast of one or more regions, as returned by main or forecast_for_region.
+    method : str
+        'residual' refits (k, x0) to the fitted curve plus residuals resampled with replacement.
+        'parametric' draws (k, x0) from a normal distribution with the covariance of the fit, without refitting.
+    n_boot : int
+        The number of draws per region.
+    seed : int
+        The seed of the random generator.
+    quantiles : sequence
+        The quantiles to add, as columns named p10, p50 and p90 for the defaults.
+    parallel : bool
+        If True, the batches are drawn in parallel in a process pool.
+    workers : int, optional
+        The number of worker processes. Defaults to the number of CPUs.
+    batch_size : int
+        The number of draws per batch.
+
+    Returns
+    -------
+    pandas.DataFrame
+        The forecast with one column per quantile. Regions whose point fit failed or is degenerate get NaN bands.
+    """
+    if method not in ('residual', 'parametric'):
+        raise ValueError(f"Unknown interval method '{method}'. Use 'residual' or 'parametric'.")
+
+    _, time_range = create_date_range()
+    n_horizon = len(time_range)
+    region_values = forecast['region'].to_numpy()
+    forecast_regions = list(pd.unique(region_values))
+    blocks = [np.flatnonzero(region_values == region) for region in forecast_regions]
+
+    # Each region block is its actual rows followed by the horizon rows, see forecast_for_region
+    x, y, t_eval, L, params = [], [], [], [], []
+    for block in blocks:
+        rows = forecast.iloc[block]
+        actual = rows.iloc[:len(rows) - n_horizon]
+        x.append(actual['t'].to_numpy(dtype=float))
+        y.append(actual['service_1'].to_numpy(dtype=float))
+        t_eval.append(np.concatenate([x[-1], np.asarray(time_range, dtype=float)]))
+        L.append(actual['L'].iloc[0])
+        params.append([actual['k'].iloc[0], actual['x0'].iloc[0]])
+    x, y, t_eval = _stack_series(x), _stack_series(y), _stack_series(t_eval)
+    L, params = np.array(L, dtype=float), np.array(params, dtype=float)
+    point_ok = ~((params == 0).all(axis=1))
+
+    with np.errstate(over='ignore'):
+        fitted = L[:, np.newaxis] / (1 + np.exp(-params[:, 0:1] * (x - params[:, 1:2])))
+    residuals = y - fitted
+    _, cov, _ = fit_logistic_batch(x, y, L, p0=params, max_iter=0)
+
+    # A fit whose covariance is singular cannot be resampled. For a step function only the observation at the
+    # step moves with (k, x0), so k and x0 are perfectly correlated.
+    with np.errstate(invalid='ignore', divide='ignore', over='ignore'):
+        correlation = cov[:, 0, 1] ** 2 / (cov[:, 0, 0] * cov[:, 1, 1])
+        degenerate = ~(np.isfinite(cov).all(axis=(1, 2)) & (cov[:, 0, 0] > 0) & (cov[:, 1, 1] > 0)
+                       & (correlation < 1 - 1e-9))
+    for r in np.flatnonzero(point_ok & degenerate):
+        print(f"The fit for {forecast_regions[r]} is degenerate, its prediction intervals are left empty.")
+    point_ok &= ~degenerate
+
+    sizes = [min(batch_size, n_boot - start) for start in range(0, n_boot, batch_size)]
+    seeds = np.random.SeedSequence(seed).spawn(len(sizes))
+    draw = partial(_bootstrap_batch, x, fitted, residuals, L, params, cov, t_eval, method)
+
+    with span('monthly_user_forecast.intervals', f"Drawing {n_boot} {method} bootstrap forecasts for {len(blocks)} regions...",
+              method=method, draws=n_boot, regions=len(blocks)):
+        if parallel and len(sizes) > 1:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                batches = list(executor.map(draw, sizes, seeds))
+        else:
+            batches = [draw(size, batch_seed) for size, batch_seed in zip(sizes, seeds)]
+        curves = np.concatenate([batch[0] for batch in batches])
+        noise = np.concatenate([batch[1] for batch in batches])
+        with np.errstate(over='ignore', invalid='ignore'):
+            point = L[:, np.newaxis] / (1 + np.exp(-params[:, 0:1] * (t_eval - params[:, 1:2])))
+            draws = curves - np.nanmedian(curves, axis=0) + point + noise
+            draws = np.clip(draws, 0.0, L[np.newaxis, :, np.newaxis])
+            bands = np.nanquantile(draws, quantiles, axis=0)
+    bands[:, ~point_ok] = np.nan
+
+    forecast = forecast.copy()
+    for q, band in zip(quantiles, bands):
+        column = np.full(len(forecast), np.nan)
+        for r, block in enumerate(blocks):
+            column[block] = band[r, :len(block)]
+        forecast[f"p{round(q * 100):g}"] = column
+    return forecast
+
+def _parameter_keys(forecast):
+    """
+    Returns the columns that identify one fitted curve in a forecast.
+    """
+    return ['region', 'service'] if 'service' in forecast.columns else ['region']
+
+def parameter_table(forecast):
+    """
+    This function collapses a forecast to one row of logistic parameters per region (and service).
+
+    Parameters
+    ----------
+    forecast : pandas.DataFrame
+        The output of main, forecast_for_region or forecast_all_services.
+
+    Returns
+    -------
+    pandas.DataFrame
+        A dataframe with the following columns:
+            - region
+            - service (only for forecast_all_services output)
+            - L
+            - k
+            - x0
+            - start_date: the date at which t is 0
+    """
+    keys = _parameter_keys(forecast)
+    grouped = forecast.groupby(keys, sort=False)
+    parameters = grouped[['L', 'k', 'x0']].first()
+    parameters['start_date'] = grouped['date'].min()
+    return parameters.reset_index()
+
+def render_formulas(forecast, parameters=None):
+    """
+    This function renders the logistic formula of each forecast row as text, on demand.
+
+    Parameters
+    ----------
+    forecast : pandas.DataFrame
+        The output of main, forecast_for_region or forecast_all_services.
+    parameters : pandas.DataFrame, optional
+        The output of parameter_table. Computed from forecast when not given.
+
+    Returns
+    -------
+    pandas.Series
+        The formula of each row, aligned with the index of forecast.
+    """
+    if parameters is None:
+        parameters = parameter_table(forecast)
+    keys = _parameter_keys(forecast)
+    rows = forecast[keys].merge(parameters, on=keys, how='left')
+    formulas = rows['L'].astype(str) + ' / (1 + exp(-' + rows['k'].astype(str) + ' * (' + \
+        forecast['t'].astype(str).to_numpy() + ' - ' + rows['x0'].astype(str) + ')))'
+    formulas.index = forecast.index
+    return formulas
+
+def excel_formulas(forecast, parameters, parameter_sheet, t_column, parameter_first_row=2):
+    """
+    This function builds native Excel formulas that reference the parameter cells instead of repeating the values.
+
+    The parameter table is expected to be written to parameter_sheet as-is, with its header in the row
+    above parameter_first_row and its columns starting at column A.
+
+    Parameters
+    ----------
+    forecast : pandas.DataFrame
+        The output of main, forecast_for_region or forecast_all_services, in the order it is written to Excel.
+    parameters : pandas.DataFrame
+        The output of parameter_table, in the order it is written to parameter_sheet.
+    parameter_sheet : str
+        The name of the sheet holding the parameter table.
+    t_column : str
+        The column letter of the t values in the forecast sheet, e.g. 'J'. The forecast is assumed to be
+        written with its header in row 1, so the first forecast row is row 2.
+    parameter_first_row : int
+        The sheet row of the first parameter row.
+
+    Returns
+    -------
+    pandas.Series
+        The formula of each row, aligned with the index of forecast.
+    """
+    keys = _parameter_keys(forecast)
+    letters = {col: chr(ord('A') + i) for i, col in enumerate(parameters.columns)}
+    parameter_rows = parameters[keys].reset_index(drop=True)
+    parameter_rows['parameter_row'] = np.arange(len(parameters)) + parameter_first_row
+    sheet_rows = forecast[keys].merge(parameter_rows, on=keys, how='left')['parameter_row'].astype(str).to_numpy()
+    forecast_rows = (np.arange(len(forecast)) + 2).astype(str)
+
+    def cell(col):
+        return f"'{parameter_sheet}'!${letters[col]}$" + sheet_rows
+
+    formulas = '=' + cell('L') + '/(1+EXP(-' + cell('k') + '*(' + t_column + forecast_rows + '-' + cell('x0') + ')))'
+    return pd.Series(formulas, index=forecast.index)
+
+@traced('monthly_user_forecast.main')
+def main(parallel=False, workers=None, fit_method='curve_fit', cache_path=None, all_services=False, source='pandas',
+         scenario_ceilings=None, intervals=None, n_boot=1000, seed=0):
+    """
+    This function produces the forecast for every region that is not skipped.
+
+    Parameters
+    ----------
+    parallel : bool
+        If True, the regions are fitted in parallel in a process pool.
+    workers : int, optional
+        The number of worker processes. Defaults to the number of CPUs.
+    fit_method : str
+        'curve_fit' fits each region separately with scipy. 'batched' fits all regions at once
+        with fit_logistic_batch, in which case parallel and workers are not used.
+    cache_path : str, optional
+        The path of the on-disk parameter cache used by the batched fit, so only regions whose data
+        or ceiling changed are refitted. Requires fit_method='batched'.
+    all_services : bool
+        If True, every service column is forecast in one batched pass with forecast_all_services
+        and the combined frame is returned instead of the service_1 forecast.
+    source : str
+        Where the user counts are computed, see extract_user_data.
+    scenario_ceilings : numpy.ndarray or dict, optional
+        Alternative ceilings per region, e.g. from ceiling_grid. If given, every scenario is fitted and evaluated
+        with forecast_ceiling_scenarios and its array output is returned instead of the forecast dataframe.
+    intervals : str, optional
+        'residual' or 'parametric' adds P10/P50/P90 columns with add_prediction_intervals, drawn in the
+        process pool when parallel is True.
+    n_boot : int
+        The number of bootstrap draws per region for the intervals.
+    seed : int
+        The seed of the bootstrap draws, so the intervals are reproducible.
+
+    Returns
+    -------
+    pandas.DataFrame
+        The forecasts for all regions, in the same order as the regions in the ceilings.
+    """
+    df = extract_user_data(source=source)
+    forecast_regions = [region for region in regions if region not in skipped_regions]
+
+    if scenario_ceilings is not None:
+        scenarios = forecast_ceiling_scenarios(df, forecast_regions, scenario_ceilings)
+        print("Forecasting complete.")
+        return scenarios
+
+    if all_services:
+        forecast_df = forecast_all_services(df, forecast_regions, ceilings)
+        print("Forecasting complete.")
+        return forecast_df
+
+    if cache_path and fit_method != 'batched':
+        raise ValueError("The parameter cache requires fit_method='batched'.")
+
+    if fit_method == 'batched':
+        forecasts = forecast_regions_batched(df, forecast_regions, ceilings, cache_path=cache_path)
+    elif fit_method != 'curve_fit':
+        raise ValueError(f"Unknown fit method '{fit_method}'. Use 'curve_fit' or 'batched'.")
+    elif parallel:
+        # Only send each worker the rows for its own region
+        region_views = [df.loc[df['region'] == region] for region in forecast_regions]
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            # map() returns the results in submission order, so the output is deterministic
+            forecasts = list(executor.map(partial(forecast_for_specific_region, ceilings=ceilings),
+                                          region_views, forecast_regions))
+    else:
+        forecasts = [forecast_for_specific_region(df, region, ceilings) for region in forecast_regions]
+
+    # Concatenate once at the end instead of growing the dataframe inside the loop
+    forecast_df = pd.concat(forecasts) if forecasts else pd.DataFrame()
 
-    for region in regions:
-        if region not in skipped_regions:
-            forecast = forecast_for_specific_region(df, region, ceilings)
-            forecast_df = pd.concat([forecast_df, forecast])
+    if intervals and forecasts:
+        forecast_df = add_prediction_intervals(forecast_df, method=intervals, n_boot=n_boot, seed=seed,
+                                               parallel=parallel, workers=workers)
 
     print("Forecasting complete.")
     return forecast_df
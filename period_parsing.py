@@ -0,0 +1,50 @@
+"""
+This module contains vectorized parsing of period and quarter labels such as '2023Q4'.
+
+The exports and calculators only ever see a few dozen distinct period labels, repeated over many rows or columns.
+Parsing each distinct label once and mapping the results back with a lookup array makes the cost of date conversion
+scale with the number of distinct periods instead of the number of rows.
+
+Functions:
+----------
+parse_periods(values, converter): parses each distinct label once and maps the dates back to every value
+cached_converter(converter): wraps a single-label converter so repeated labels are only parsed once
+"""
+
+from functools import lru_cache
+
+import numpy as np
+import pandas as pd
+
+def parse_periods(values, converter):
+    """
+    Parses each distinct label once and maps the dates back to every value.
+
+    Parameters:
+    - values (pandas.Series or array-like): The period labels.
+    - converter (function): Converts one label to a date, e.g. convert_quarter_to_datetime.
+
+    Returns:
+    - dates (pandas.Series or numpy.ndarray): The datetime64[ns] date of each value, NaT for missing labels.
+      A Series keeps the index of values.
+    """
+    codes, uniques = pd.factorize(values)
+    lookup = pd.to_datetime([converter(label) for label in uniques]).to_numpy(dtype='datetime64[ns]')
+    # Missing labels get code -1, which points at the NaT appended to the lookup
+    lookup = np.append(lookup, np.datetime64('NaT', 'ns'))
+    dates = lookup[codes]
+    if isinstance(values, pd.Series):
+        return pd.Series(dates, index=values.index, name=values.name)
+    return dates
+
+def cached_converter(converter):
+    """
+    Wraps a single-label converter so repeated labels are only parsed once.
+
+    Parameters:
+    - converter (function): Converts one label to a date, e.g. convert_period_to_datetime.
+
+    Returns:
+    - cached (function): The same converter with an unbounded cache of the labels seen so far.
+    """
+    return lru_cache(maxsize=None)(converter)
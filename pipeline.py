@@ -0,0 +1,111 @@
+"""
+This module contains a small dependency-aware runner for the refresh pipeline.
+
+Each stage is a function plus the names of the stages whose outputs it takes as arguments.
+Every stage runs at most once per run, so an extract shared by several stages is only pulled once.
+Stages whose inputs are ready run concurrently on a thread pool when requested, and only the stages
+needed for the requested targets are run.
+
+Functions:
+----------
+required_stages(stages, targets): returns the targets and every stage they depend on
+run_pipeline(stages, targets=None, concurrent=False, workers=None): runs the stages in dependency order
+"""
+
+import traceback
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from instrumentation import span
+
+def required_stages(stages, targets):
+    """
+    Returns the targets and every stage they depend on.
+
+    Parameters:
+    - stages (dict): The [function, input names] of each stage, by stage name.
+    - targets (list): The names of the stages whose outputs are wanted.
+
+    Returns:
+    - needed (set): The names of the stages to run.
+    """
+    needed = set()
+    pending = list(targets)
+    while pending:
+        name = pending.pop()
+        if name in needed:
+            continue
+        if name not in stages:
+            raise KeyError(f"Unknown pipeline stage '{name}'.")
+        needed.add(name)
+        pending.extend(stages[name][1])
+    return needed
+
+def _run_stage(stages, name, results):
+    func, inputs = stages[name]
+    with span(f"pipeline.{name}") as s:
+        result = func(*[results[input_name] for input_name in inputs])
+        if hasattr(result, 'memory_usage'):
+            s.frame_out(result)
+    return result
+
+def run_pipeline(stages, targets=None, concurrent=False, workers=None):
+    """
+    Runs the stages in dependency order, each at most once.
+
+    A stage whose function raises is recorded as failed, and the stages depending on it are skipped
+    and recorded as failed as well, while independent stages carry on.
+
+    Parameters:
+    - stages (dict): The [function, input names] of each stage, by stage name. The function is called
+      with the outputs of the input stages as positional arguments, in the order they are listed.
+    - targets (list): The names of the stages whose outputs are wanted. Defaults to every stage.
+    - concurrent (bool): If True, stages whose inputs are ready run in parallel on a thread pool.
+    - workers (int): The number of threads. Defaults to the number of stages to run.
+
+    Returns:
+    - results (dict): The output of every stage that succeeded, including the shared intermediate stages.
+    - failures (dict): The formatted traceback, or the name of the failed input, of every stage that failed.
+    """
+    needed = required_stages(stages, list(stages) if targets is None else targets)
+    results, failures = {}, {}
+    remaining = set(needed)
+
+    def ready():
+        for name in sorted(remaining):
+            inputs = stages[name][1]
+            failed_inputs = [input_name for input_name in inputs if input_name in failures]
+            if failed_inputs:
+                remaining.discard(name)
+                failures[name] = f"Skipped because the input stage '{failed_inputs[0]}' failed."
+                return ready()
+        return [name for name in sorted(remaining) if all(i in results for i in stages[name][1])]
+
+    if not concurrent:
+        while remaining:
+            runnable = ready()
+            if not runnable:
+                break
+            for name in runnable:
+                remaining.discard(name)
+                try:
+                    results[name] = _run_stage(stages, name, results)
+                except Exception:
+                    failures[name] = traceback.format_exc()
+        return results, failures
+
+    with ThreadPoolExecutor(max_workers=workers or max(len(needed), 1)) as executor:
+        running = {}
+        while remaining or running:
+            for name in ready():
+                remaining.discard(name)
+                running[executor.submit(_run_stage, stages, name, dict(results))] = name
+            if not running:
+                break
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                try:
+                    results[name] = future.result()
+                except Exception:
+                    failures[name] = traceback.format_exc()
+    return results, failures
@@ -0,0 +1,116 @@
+"""
+This module contains a local cache for the results of the database export queries.
+
+Results are stored as Parquet files, keyed by the compiled SQL statement and the export parameters.
+Each entry records the watermark of the source tables (e.g. the max update_time) at the time it was pulled,
+and it is only reused while the watermark in the database is unchanged. Checking the watermark is a single
+scalar query, so repeat runs load from local disk instead of pulling the full result again.
+
+Functions:
+----------
+query_cache_key(stmt, bind, params=None): builds the cache key of a statement and its parameters
+cached_read_sql(stmt, bind, params=None, watermark_stmt=None, cache_dir=query_cache_dir): reads a query through the cache
+clear_query_cache(cache_dir=query_cache_dir): deletes every cached result
+
+Module imports:
+---------------
+pyarrow (optional): required to read and write the Parquet files. Without it, queries are read from the database.
+"""
+
+import hashlib
+import json
+import os
+
+import pandas as pd
+
+query_cache_dir = os.path.join(os.path.expanduser('~'), '.cache', 'query_results')
+
+def _parquet_available():
+    try:
+        import pyarrow  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+def query_cache_key(stmt, bind, params=None):
+    """
+    Builds the cache key of a statement and its parameters.
+
+    Parameters:
+    - stmt (SQLAlchemy Select): The statement to run.
+    - bind (SQLAlchemy Engine or Connection): The database the statement is compiled for.
+    - params (dict): The export parameters, e.g. time_range and countries.
+
+    Returns:
+    - key (str): A hex digest of the compiled SQL, its bound values and the parameters.
+    """
+    compiled = stmt.compile(dialect=bind.dialect)
+    digest = hashlib.sha256()
+    digest.update(str(compiled).encode())
+    digest.update(repr(sorted(compiled.params.items())).encode())
+    digest.update(json.dumps(params or {}, sort_keys=True, default=str).encode())
+    return digest.hexdigest()
+
+def _read_watermark(watermark_stmt, bind):
+    """
+    Reads the watermark of the source tables as a list of strings, so it can be stored as JSON.
+    """
+    with bind.connect() as connection:
+        row = connection.execute(watermark_stmt).fetchone()
+    return [str(value) for value in row] if row is not None else None
+
+def cached_read_sql(stmt, bind, params=None, watermark_stmt=None, cache_dir=query_cache_dir):
+    """
+    Reads a query through the local cache.
+
+    Parameters:
+    - stmt (SQLAlchemy Select): The statement to run.
+    - bind (SQLAlchemy Engine): The database to run it against.
+    - params (dict): The export parameters, e.g. time_range and countries. They are part of the cache key.
+    - watermark_stmt (SQLAlchemy Select): A cheap query returning one row that changes whenever the source
+      tables change, e.g. the max update_time. Without it, a cached result never expires.
+    - cache_dir (str): The directory of the cached results.
+
+    Returns:
+    - data_df (pandas.DataFrame): The result of the query.
+    """
+    if not _parquet_available():
+        print("pyarrow is not installed, reading the query from the database...")
+        return pd.read_sql(stmt, bind)
+
+    key = query_cache_key(stmt, bind, params)
+    data_path = os.path.join(cache_dir, key + '.parquet')
+    meta_path = os.path.join(cache_dir, key + '.json')
+    watermark = _read_watermark(watermark_stmt, bind) if watermark_stmt is not None else None
+
+    if os.path.exists(data_path) and os.path.exists(meta_path):
+        with open(meta_path) as f:
+            meta = json.load(f)
+        if meta['watermark'] == watermark:
+            print(f"Loading the query results from the local cache ({key[:12]})...")
+            return pd.read_parquet(data_path)
+        print("The source tables have changed since the cached pull.")
+
+    data_df = pd.read_sql(stmt, bind)
+
+    os.makedirs(cache_dir, exist_ok=True)
+    temp_path = data_path + '.tmp'
+    data_df.to_parquet(temp_path, index=False)
+    os.replace(temp_path, data_path)
+    with open(meta_path, 'w') as f:
+        json.dump({'watermark': watermark, 'params': params, 'created': pd.Timestamp.now().isoformat()},
+                  f, indent=2, default=str)
+    return data_df
+
+def clear_query_cache(cache_dir=query_cache_dir):
+    """
+    Deletes every cached result.
+
+    Parameters:
+    - cache_dir (str): The directory of the cached results.
+    """
+    if not os.path.isdir(cache_dir):
+        return
+    for name in os.listdir(cache_dir):
+        if name.endswith(('.parquet', '.json')):
+            os.remove(os.path.join(cache_dir, name))
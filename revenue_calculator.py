@@ -3,27 +3,85 @@ This file contains the functions for calculating the estimated metrics in local
 
 Functions
 ---------
-metric_calculator(basic_data, master_table=master_table)
+metric_calculator(basic_data, master_table=master_table, engine='vectorized', output='wide')
     Calculates the estimated metrics in local currency for each company and subcategory in the master table.
 
-calculate_metric(master_table=master_table)
-    Exports basic_data and then applies the metric_calculator function to it.
+index_economy_metrics(basic_data, master_table)
+    Looks up the economy_metric at the index date and base territory of each company and subcategory.
+
+incremental_metrics(basic_data, master_table=master_table, store_path=metric_store_path)
+    Recomputes only the metrics whose inputs changed since the last run and merges them into the stored result.
+
+main(master_table=master_table, output='wide', basic_data=None, store_path=None)
+    Exports basic_data, unless an extract is passed in, and then applies the metric_calculator function to it.
 
 Module imports
 --------------
 utils.config.master_table: contains the master table from the database
 utils.functions.create_date_range: creates a date range from the start to the end of the forecast
 utils.database_export_funcs.basic_data_export: exports the basic_data table from the database
+period_parsing: parses each distinct period label once
+instrumentation: times the load and calculation phases
 """
 
+import os
+
 import pandas as pd
 import numpy as np
 
 from ..utils.config import master_table
 from ..utils.functions import convert_period_to_datetime, create_date_range
 from ..utils.database_export_funcs import basic_data_export
+from instrumentation import span, traced
+from period_parsing import cached_converter, parse_periods
+
+metric_store_path = os.path.join(os.path.expanduser('~'), '.cache', 'revenue_metrics.pkl')
+basic_columns = ['date', 'time', 'region', 'territory', 'currency', 'economy_metric', 'exchange_rate']
+
+def index_economy_metrics(basic_data, master_table):
+    """
+    Looks up the economy_metric at the index date and base territory of each company and subcategory.
+
+    basic_data is indexed by (date, territory) once, so every master_table row is resolved with a single join
+    instead of a boolean scan of basic_data per row. Duplicate (company, subcategory) rows in master_table
+    and duplicate (date, territory) rows in basic_data resolve to their first occurrence, as in the loop engine.
+
+    Parameters
+    ----------
+    basic_data : pandas.DataFrame
+        The basic_data table from the database.
+    master_table : pandas.DataFrame
+        The master_table from the database, including the subcategory column.
+
+    Returns
+    -------
+    pandas.DataFrame
+        A dataframe indexed by (company, subcategory) with the following columns:
+            - index_metric
+            - index_economy_metric
+    """
+    index_rows = master_table.dropna(subset=['company', 'subcategory'])
+    index_rows = index_rows.drop_duplicates(['company', 'subcategory'], keep='first')
+    index_rows = index_rows[['company', 'subcategory', 'index_time', 'base_territory', 'index_metric']].copy()
+
+    # Each distinct period label is only parsed once
+    index_rows['date'] = parse_periods(index_rows['index_time'], convert_period_to_datetime)
+
+    economy_lookup = basic_data.drop_duplicates(['date', 'territory'], keep='first')
+    economy_lookup = economy_lookup.set_index(['date', 'territory'])['economy_metric']
+    lookup_keys = pd.MultiIndex.from_arrays([index_rows['date'], index_rows['base_territory']])
+    index_rows['index_economy_metric'] = economy_lookup.reindex(lookup_keys).to_numpy()
+
+    missing = index_rows[index_rows['index_economy_metric'].isna()]
+    if not missing.empty:
+        first = missing.iloc[0]
+        raise IndexError(f"No economy_metric in basic_data for index period {first['index_time']} "
+                         f"and territory {first['base_territory']} "
+                         f"(company {first['company']}, subcategory {first['subcategory']}).")
 
-def metric_calculator(basic_data, master_table=master_table):
+    return index_rows.set_index(['company', 'subcategory'])[['index_metric', 'index_economy_metric']]
+
+def metric_calculator(basic_data, master_table=master_table, engine='vectorized', output='wide', valid_pairs=None):
     """
     Calculates the estimated metrics in local currency for each company and subcategory in the master table.
 
@@ -33,11 +91,23 @@ def metric_calculator(basic_data, master_table=master_table):
         The basic_data table from the database.
     master_table : pandas.DataFrame
         The master_table from the database.
+    engine : str
+        'vectorized' joins master_table to the (date, territory) economy_metric index once and computes every
+        company/subcategory column in one broadcast operation. 'loop' calculates the columns one at a time.
+        Both engines produce identical results.
+    output : str
+        'wide' returns one row per basic_data row and one float64 column per company/subcategory.
+        'long' returns one row per (date, territory, company, subcategory) with a non-missing metric, stored
+        as categoricals and float32. The long output is always computed with the vectorized engine.
+    valid_pairs : pandas.DataFrame, optional
+        Only used with output='long'. The (territory, company) combinations to emit, optionally narrowed by a
+        subcategory column. By default every non-missing metric is emitted, which holds the same values as
+        the wide output.
 
     Returns
     -------
     pandas.DataFrame
-        A dataframe with the following columns:
+        For output='wide', a dataframe with the following columns:
             - date
             - time
             - region
@@ -49,35 +119,187 @@ def metric_calculator(basic_data, master_table=master_table):
             - subcategory
             - year
             - period
+        For output='long', a dataframe with the following columns:
+            - date
+            - territory
+            - company
+            - subcategory
+            - value
     """
+    if output not in ('wide', 'long'):
+        raise ValueError(f"Unknown metric output '{output}'. Use 'wide' or 'long'.")
+
     date_range, time_range = create_date_range()
-    print(f"Calculating estimated metrics in local currency from {time_range[0]} to {time_range[-1]}.")
-    
+    message = f"Calculating estimated metrics in local currency from {time_range[0]} to {time_range[-1]}..."
+
     # Create a new column in master_table that combines the service_type and channel_type columns
-    print("Creating subcategory column in master_table DataFrame...")
-    new_col = 'subcategory'
-    master_table[new_col] = np.where(
-        pd.isna(master_table['channel_type']),
-        master_table['service_type'],
-        master_table['service_type'] + ' - ' + master_table['channel_type'])
+    with span('revenue_calculator.subcategory', "Creating subcategory column in master_table DataFrame..."):
+        new_col = 'subcategory'
+        master_table[new_col] = np.where(
+            pd.isna(master_table['channel_type']),
+            master_table['service_type'],
+            master_table['service_type'] + ' - ' + master_table['channel_type'])
+
+    if output == 'long':
+        with span('revenue_calculator.calculate', message, engine='long') as s:
+            s.frame_in(basic_data)
+            df = _long_metrics(basic_data, master_table, valid_pairs=valid_pairs)
+            s.frame_out(df)
+        print("Metrics calculated.")
+        return df
+    
+    if engine not in ('vectorized', 'loop'):
+        raise ValueError(f"Unknown metric engine '{engine}'. Use 'vectorized' or 'loop'.")
+
+    with span('revenue_calculator.calculate', message, engine=engine) as s:
+        s.frame_in(basic_data)
+        if engine == 'vectorized':
+            df = _vectorized_metrics(basic_data, master_table)
+        else:
+            # Prepare the DataFrame for metric calculations
+            df = pd.DataFrame(index=[basic_data['date'], 
+                                     basic_data['time'], 
+                                     basic_data['region'], 
+                                     basic_data['territory'], 
+                                     basic_data['currency'],
+                                     basic_data['economy_metric'],
+                                     basic_data['exchange_rate']],
+                              columns=[master_table['company'], master_table['subcategory']])
+            df.reset_index(inplace=True)
+            df = _loop_metrics(df, basic_data, master_table)
+        s.frame_out(df)
     
-    # Prepare the DataFrame for metric calculations
-    print("Preparing DataFrame for metric calculations...")
-    df = pd.DataFrame(index=[basic_data['date'], 
-                             basic_data['time'], 
-                             basic_data['region'], 
-                             basic_data['territory'], 
-                             basic_data['currency'],
-                             basic_data['economy_metric'],
-                             basic_data['exchange_rate']],
-                      columns=[master_table['company'], master_table['subcategory']])
-    df.reset_index(inplace=True)
+    print("Metrics calculated.")
+    df['year'] = df['date'].dt.year
+    df['period'] = df['date'].dt.quarter
+
+    return df
+
+def _metric_columns(master_table):
+    """
+    The (company, subcategory) columns of the wide output, in master_table order, duplicates included.
+    """
+    return pd.MultiIndex.from_arrays([master_table['company'], master_table['subcategory']])
+
+def _wide_frame(basic_data, columns, values):
+    """
+    Builds the wide output from the basic columns and a rows x columns block of metric values.
+    The basic columns sit at the second column level '', as reset_index of the dense frame puts them.
+    """
+    df = basic_data[basic_columns].reset_index(drop=True)
+    df.columns = pd.MultiIndex.from_arrays([basic_columns, [''] * len(basic_columns)], names=columns.names)
+    return pd.concat([df, pd.DataFrame(values, index=df.index, columns=columns)], axis=1)
+
+def _vectorized_metrics(basic_data, master_table):
+    """
+    Calculates every company/subcategory column in a single broadcast NumPy operation.
+    Only the metric block is allocated, the rows x columns frame of the loop engine is never built.
+    """
+    index_values = index_economy_metrics(basic_data, master_table)
+
+    # Align the per-column index values with the master_table column order
+    columns = _metric_columns(master_table)
+    positions = index_values.index.get_indexer(columns)
+    for company, subcategory in columns[positions < 0]:
+        print(f"No matching row for company {company} and subcategory {subcategory}")
+    found = positions >= 0
+
+    index_metric = np.full(len(columns), np.nan)
+    index_economy_metric = np.full(len(columns), np.nan)
+    index_metric[found] = index_values['index_metric'].to_numpy(dtype=float)[positions[found]]
+    index_economy_metric[found] = index_values['index_economy_metric'].to_numpy(dtype=float)[positions[found]]
+    economy_metric = basic_data['economy_metric'].to_numpy(dtype=float)
+    exchange_rate = basic_data['exchange_rate'].to_numpy(dtype=float)
+
+    # Same operation order as the loop engine so the results match exactly
+    values = (index_metric[np.newaxis, :] * (economy_metric[:, np.newaxis] / index_economy_metric[np.newaxis, :])) \
+        * exchange_rate[:, np.newaxis]
+
+    return _wide_frame(basic_data, columns, values)
+
+def _long_metrics(basic_data, master_table, valid_pairs=None, chunk_cells=2**22):
+    """
+    Calculates the metrics as a long table holding only the valid (non-missing) combinations.
 
+    Without valid_pairs every non-NaN cell of the wide output is emitted. The rows of basic_data are processed
+    in chunks of about chunk_cells metrics, so the dense rows x columns block is never materialised.
+
+    valid_pairs is an optional dataframe of the (territory, company) or (territory, company, subcategory)
+    combinations to emit. Only those combinations are calculated, so the cells outside it are never built.
+    """
+    index_values = index_economy_metrics(basic_data, master_table)
+    index_metric = index_values['index_metric'].to_numpy(dtype=float)
+    index_economy_metric = index_values['index_economy_metric'].to_numpy(dtype=float)
+    pairs = index_values.index
+    n_pairs = len(pairs)
+
+    economy_metric = basic_data['economy_metric'].to_numpy(dtype=float)
+    exchange_rate = basic_data['exchange_rate'].to_numpy(dtype=float)
+
+    if valid_pairs is None:
+        chunk_rows = max(1, chunk_cells // max(n_pairs, 1))
+        row_positions, pair_positions, values = [], [], []
+        for start in range(0, len(basic_data), chunk_rows):
+            stop = start + chunk_rows
+            block = (index_metric[np.newaxis, :] * (economy_metric[start:stop, np.newaxis] / index_economy_metric[np.newaxis, :])) \
+                * exchange_rate[start:stop, np.newaxis]
+            rows, columns = np.nonzero(~np.isnan(block))
+            row_positions.append(rows + start)
+            pair_positions.append(columns)
+            values.append(block[rows, columns].astype(np.float32))
+
+        row_positions = np.concatenate(row_positions) if row_positions else np.array([], dtype=np.intp)
+        pair_positions = np.concatenate(pair_positions) if pair_positions else np.array([], dtype=np.intp)
+        values = np.concatenate(values) if values else np.array([], dtype=np.float32)
+    else:
+        keys = [column for column in ('company', 'subcategory') if column in valid_pairs.columns]
+        if 'territory' not in valid_pairs.columns or 'company' not in keys:
+            raise KeyError("valid_pairs needs a territory and a company column.")
+        pair_frame = pd.DataFrame({
+            'company': pairs.get_level_values('company'),
+            'subcategory': pairs.get_level_values('subcategory'),
+            'pair': np.arange(n_pairs)
+        })
+        pair_territories = pair_frame.merge(
+            valid_pairs[['territory'] + keys].astype(object).drop_duplicates(), on=keys)
+        rows = pd.DataFrame({
+            'territory': basic_data['territory'].to_numpy(dtype=object),
+            'row': np.arange(len(basic_data))
+        })
+        combinations = rows.merge(pair_territories[['territory', 'pair']], on='territory')
+        combinations.sort_values(['row', 'pair'], inplace=True)
+        row_positions = combinations['row'].to_numpy()
+        pair_positions = combinations['pair'].to_numpy()
+
+        # Same operation order as the wide engines, rounded to float32 at the end
+        values = (index_metric[pair_positions] * (economy_metric[row_positions] / index_economy_metric[pair_positions])) \
+            * exchange_rate[row_positions]
+        present = ~np.isnan(values)
+        row_positions, pair_positions = row_positions[present], pair_positions[present]
+        values = values[present].astype(np.float32)
+
+    territory_codes, territories = pd.factorize(basic_data['territory'])
+    company_codes, companies = pd.factorize(pairs.get_level_values('company'))
+    subcategory_codes, subcategories = pd.factorize(pairs.get_level_values('subcategory'))
+
+    df = pd.DataFrame({
+        'date': basic_data['date'].to_numpy()[row_positions],
+        'territory': pd.Categorical.from_codes(territory_codes[row_positions], categories=territories),
+        'company': pd.Categorical.from_codes(company_codes[pair_positions], categories=companies),
+        'subcategory': pd.Categorical.from_codes(subcategory_codes[pair_positions], categories=subcategories),
+        'value': values
+    })
+    return df
+
+def _loop_metrics(df, basic_data, master_table):
+    """
+    Calculates each company/subcategory column of df one at a time.
+    """
     col_list = list(df.columns)
     i = 7
+    convert_period = cached_converter(convert_period_to_datetime)
 
     # Calculate the metric for each company/subcategory
-    print("Calculating metrics...")
     while i < len(col_list):
         company = col_list[i][0]
         subcategory = col_list[i][1]
@@ -86,7 +308,7 @@ def metric_calculator(basic_data, master_table=master_table):
         
         if not row.empty:
             index_time = row['index_time'].values[0]
-            index_date = convert_period_to_datetime(index_time)
+            index_date = convert_period(index_time)
             index_territory = row['base_territory'].values[0]
             index_currency = row['base_currency'].values[0]
             index_metric = row['index_metric'].values[0]
@@ -97,15 +319,151 @@ def metric_calculator(basic_data, master_table=master_table):
             print(f"No matching row for company {company} and subcategory {subcategory}")
 
         i += 1
-    
-    print("Metrics calculated.")
+
+    return df
+
+def _row_keys(basic_data):
+    """
+    Identifies each basic_data row by (date, territory) and its occurrence, so duplicate keys stay distinct.
+    """
+    occurrence = basic_data.groupby(['date', 'territory'], sort=False, dropna=False).cumcount()
+    return pd.MultiIndex.from_arrays([basic_data['date'].to_numpy(), basic_data['territory'].to_numpy(), occurrence.to_numpy()],
+                                     names=['date', 'territory', 'occurrence'])
+
+def _unchanged_positions(old_keys, old_inputs, new_keys, new_inputs):
+    """
+    Returns the position of each new key in the stored keys, or -1 if the key is new or one of its inputs changed.
+    """
+    positions = old_keys.get_indexer(new_keys) if len(old_keys) else np.full(len(new_keys), -1)
+    found = positions >= 0
+    for old, new in zip(old_inputs, new_inputs):
+        previous = np.full(len(new), np.nan)
+        previous[found] = old[positions[found]]
+        # NaN inputs on both sides count as unchanged
+        same = (previous == new) | (np.isnan(previous) & np.isnan(new))
+        positions = np.where(same, positions, -1)
+    return positions
+
+def _load_metric_store(store_path):
+    if store_path and os.path.exists(store_path):
+        return pd.read_pickle(store_path)
+    return None
+
+def _save_metric_store(store, store_path):
+    """
+    Writes the store to a temporary file first, so an interrupted run keeps the previous store.
+    """
+    directory = os.path.dirname(store_path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    temp_path = store_path + '.tmp'
+    pd.to_pickle(store, temp_path)
+    os.replace(temp_path, store_path)
+
+def incremental_metrics(basic_data, master_table=master_table, store_path=metric_store_path):
+    """
+    Recomputes only the metrics whose inputs changed since the last run and merges them into the stored result.
+
+    A metric depends only on the index_metric and index economy_metric of its company and subcategory and on
+    the economy_metric and exchange_rate of its basic_data row. The store keeps these inputs next to the metric
+    values. A column is recomputed when its master_table row was edited or its index economy_metric changed,
+    a row is recomputed when it is new or its economy_metric or exchange_rate changed, and every other value is
+    copied from the store. The result is identical to metric_calculator with the vectorized engine.
+
+    Parameters
+    ----------
+    basic_data : pandas.DataFrame
+        The basic_data table from the database.
+    master_table : pandas.DataFrame
+        The master_table from the database.
+    store_path : str
+        The file of the persisted result store. It is created by the first run.
+
+    Returns
+    -------
+    pandas.DataFrame
+        The same dataframe as metric_calculator with output='wide'.
+    """
+    master_table = master_table.copy()
+    master_table['subcategory'] = np.where(
+        pd.isna(master_table['channel_type']),
+        master_table['service_type'],
+        master_table['service_type'] + ' - ' + master_table['channel_type'])
+
+    index_values = index_economy_metrics(basic_data, master_table)
+    pair_keys = index_values.index
+    index_metric = index_values['index_metric'].to_numpy(dtype=float)
+    index_economy_metric = index_values['index_economy_metric'].to_numpy(dtype=float)
+    row_keys = _row_keys(basic_data)
+    economy_metric = basic_data['economy_metric'].to_numpy(dtype=float)
+    exchange_rate = basic_data['exchange_rate'].to_numpy(dtype=float)
+
+    store = _load_metric_store(store_path)
+    if store is None:
+        print("No metric store found, calculating every metric...")
+        empty = pd.MultiIndex.from_arrays([[], []])
+        store = {'pair_keys': empty, 'index_metric': np.array([]), 'index_economy_metric': np.array([]),
+                 'row_keys': empty, 'economy_metric': np.array([]), 'exchange_rate': np.array([]),
+                 'values': np.empty((0, 0))}
+
+    pair_positions = _unchanged_positions(store['pair_keys'], [store['index_metric'], store['index_economy_metric']],
+                                          pair_keys, [index_metric, index_economy_metric])
+    row_positions = _unchanged_positions(store['row_keys'], [store['economy_metric'], store['exchange_rate']],
+                                         row_keys, [economy_metric, exchange_rate])
+    changed_pairs = np.flatnonzero(pair_positions < 0)
+    changed_rows = np.flatnonzero(row_positions < 0)
+    kept_pairs = np.flatnonzero(pair_positions >= 0)
+    kept_rows = np.flatnonzero(row_positions >= 0)
+
+    with span('revenue_calculator.calculate', f"Recalculating {len(changed_pairs)} of {len(pair_keys)} company/subcategory "
+              f"columns and {len(changed_rows)} of {len(row_keys)} rows...", engine='incremental') as s:
+        s.frame_in(basic_data)
+        values = np.empty((len(row_keys), len(pair_keys)))
+        values[np.ix_(kept_rows, kept_pairs)] = store['values'][np.ix_(row_positions[kept_rows], pair_positions[kept_pairs])]
+
+        # Same operation order as the vectorized engine so the results match exactly
+        def calculate(rows, pairs):
+            return (index_metric[np.newaxis, pairs] * (economy_metric[rows, np.newaxis] / index_economy_metric[np.newaxis, pairs])) \
+                * exchange_rate[rows, np.newaxis]
+
+        values[:, changed_pairs] = calculate(np.arange(len(row_keys)), changed_pairs)
+        values[np.ix_(changed_rows, kept_pairs)] = calculate(changed_rows, kept_pairs)
+        s.set(changed_pairs=len(changed_pairs), changed_rows=len(changed_rows))
+
+    _save_metric_store({
+        'pair_keys': pair_keys, 'index_metric': index_metric, 'index_economy_metric': index_economy_metric,
+        'row_keys': row_keys, 'economy_metric': economy_metric, 'exchange_rate': exchange_rate, 'values': values
+    }, store_path)
+
+    # Expand to the master_table column order, duplicates and unmatched rows included, as metric_calculator does
+    columns = _metric_columns(master_table)
+    column_positions = pair_keys.get_indexer(columns)
+    for company, subcategory in columns[column_positions < 0]:
+        print(f"No matching row for company {company} and subcategory {subcategory}")
+    wide = np.where(column_positions >= 0, values[:, column_positions], np.nan)
+
+    df = _wide_frame(basic_data, columns, wide)
     df['year'] = df['date'].dt.year
     df['period'] = df['date'].dt.quarter
-
+    print("Metrics calculated.")
     return df
 
-def main(master_table=master_table):
-    basic_data = basic_data_export()[['date','time','region','territory','economy_metric','currency','exchange_rate']]
+@traced('revenue_calculator.main')
+def main(master_table=master_table, output='wide', basic_data=None, store_path=None):
+    # A pipeline can pass in a basic_data extract it already pulled for another stage
+    if basic_data is None:
+        with span('revenue_calculator.load') as s:
+            basic_data = basic_data_export()
+            s.frame_out(basic_data)
+    missing = [column for column in basic_columns if column not in basic_data.columns]
+    if missing:
+        raise KeyError(f"The basic_data extract is missing the columns {missing} needed for the metrics.")
+    basic_data = basic_data[['date','time','region','territory','economy_metric','currency','exchange_rate']]
     print("")
-    df = metric_calculator(basic_data=basic_data, master_table=master_table)
+    if store_path:
+        # Only the metrics whose inputs changed since the stored run are recalculated
+        if output != 'wide':
+            raise ValueError("The metric store only supports output='wide'.")
+        return incremental_metrics(basic_data, master_table=master_table, store_path=store_path)
+    df = metric_calculator(basic_data=basic_data, master_table=master_table, output=output)
     return df
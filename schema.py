@@ -0,0 +1,150 @@
+"""
+This module is the central registry of the dtypes used by the exports.
+
+Identifier columns such as region, territory and company repeat on every row. Stored as Python strings,
+they take up most of the memory of the export frames and slow down sorts, groupbys and comparisons.
+The registry gives each of these columns one shared categorical dtype, so frames from different exports
+can be concatenated and merged without falling back to object columns. The count and calendar columns are
+cast to the fixed integer type registered for them, and every other numeric column keeps its type, so the
+schema of an export never depends on the values of one run.
+
+The categories of a column are the sorted union of every value registered so far, so sorting a categorical
+column gives the same order as sorting the strings. Exports register the configured values and lookups first,
+e.g. countries for territory, before converting a frame, so the category sets do not depend on the rows of one
+frame and stay the same from run to run. A frame's own values are registered for all of its columns before any
+column is cast, so a column and its aliases always share one dtype.
+
+Functions:
+----------
+register_categories(column, values): adds values to the categories of a column
+category_dtype(column): returns the shared categorical dtype of a column
+apply_schema(data_df, name=None, report=True): converts the registered categorical and numeric columns
+"""
+
+import threading
+
+import pandas as pd
+
+from instrumentation import span
+
+# Columns stored as shared categoricals, with the values known up front
+categorical_columns = {
+    'region': [],
+    'territory': [],
+    'company': [],
+    'currency': [],
+    'business_line': [],
+    'service_type': ['type1', 'type2', 'type3', 'type4', 'type5', 'type6', 'other'],
+    'online_service': [],
+    'rate_type': [],
+    'forecast_flag': ['A', 'F'],
+    'category': []
+}
+
+# Integer columns and their fixed dtype, wide enough for arithmetic on them not to overflow
+numeric_dtypes = {
+    'year': 'int32',
+    'quarter': 'int32',
+    'period': 'int32',
+    'num_users': 'int32',
+    'sample_size': 'int32'
+}
+
+# Columns that hold the same values as a registered column and share its dtype
+column_aliases = {
+    'country': 'territory',
+    'output_currency': 'currency',
+    'exchange_rate_type': 'rate_type'
+}
+
+_categories = {column: sorted(values) for column, values in categorical_columns.items()}
+_dtypes = {}
+_lock = threading.Lock()
+
+def _registered(column):
+    column = column_aliases.get(column, column)
+    return column if column in _categories else None
+
+def register_categories(column, values):
+    """
+    Adds values to the categories of a column.
+
+    Parameters:
+    - column (str): A registered column or alias, e.g. 'territory' or 'country'.
+    - values (iterable): The values to add. Missing values are ignored.
+    """
+    key = _registered(column)
+    if key is None:
+        raise KeyError(f"Column '{column}' is not in the schema registry.")
+    new = {value for value in pd.unique(pd.Series(list(values), dtype=object)) if not pd.isna(value)}
+    with _lock:
+        if not new.issubset(_categories[key]):
+            _categories[key] = sorted(new.union(_categories[key]))
+            _dtypes.pop(key, None)
+
+def category_dtype(column):
+    """
+    Returns the shared categorical dtype of a registered column or alias.
+    """
+    key = _registered(column)
+    if key is None:
+        raise KeyError(f"Column '{column}' is not in the schema registry.")
+    with _lock:
+        if key not in _dtypes:
+            _dtypes[key] = pd.CategoricalDtype(_categories[key])
+        return _dtypes[key]
+
+def _cast_numeric(series, dtype):
+    """
+    Casts an integer column to its registered dtype. Columns that are not plain integers, e.g. a count
+    with missing values read as float, are left as they are.
+    """
+    if pd.api.types.is_bool_dtype(series) or isinstance(series.dtype, pd.api.extensions.ExtensionDtype):
+        return series
+    if not pd.api.types.is_integer_dtype(series):
+        return series
+    return series.astype(dtype)
+
+def apply_schema(data_df, name=None, report=True):
+    """
+    Converts the registered columns to their shared categorical dtype and the count and calendar columns
+    to their fixed integer dtype.
+
+    Parameters:
+    - data_df (pandas.DataFrame): The export frame. It is converted in place and returned.
+    - name (str): The name of the frame in the memory report, e.g. 'data_export'.
+    - report (bool): If True, the memory before and after the conversion is printed.
+
+    Returns:
+    - data_df (pandas.DataFrame): The converted frame.
+    """
+    with span('schema.apply', frame=name) as s:
+        before = data_df.memory_usage(index=True, deep=True).sum() if report else None
+
+        # Register the values of every column and alias first, so a column and its aliases, e.g. currency and
+        # output_currency, are cast to the same dtype
+        registered = []
+        for column in data_df.columns:
+            series = data_df[column]
+            if _registered(column) is not None:
+                if isinstance(series.dtype, pd.CategoricalDtype):
+                    values = series.cat.categories
+                elif series.dtype == object or pd.api.types.is_string_dtype(series):
+                    values = series.unique()
+                else:
+                    continue
+                register_categories(column, values)
+                registered.append(column)
+
+        for column in data_df.columns:
+            if column in registered:
+                data_df[column] = data_df[column].astype(category_dtype(column))
+            elif column in numeric_dtypes:
+                data_df[column] = _cast_numeric(data_df[column], numeric_dtypes[column])
+
+        if report:
+            after = data_df.memory_usage(index=True, deep=True).sum()
+            s.set(bytes_before=int(before), bytes_after=int(after))
+            saved = 1 - after / before if before else 0.0
+            print(f"{name or 'Frame'}: {before / 2**20:.1f} MB -> {after / 2**20:.1f} MB ({saved:.0%} smaller).")
+    return data_df
@@ -0,0 +1,30 @@
+import os
+import sys
+
+import pytest
+import sqlalchemy as sa
+
+package_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, package_dir)
+
+import benchmark
+
+
+def load(name, namespace):
+    """
+    Loads a pipeline module with the benchmark stand-in injected for its warehouse imports.
+    """
+    return benchmark.load_module(os.path.join(package_dir, name), namespace)
+
+
+@pytest.fixture(scope='session')
+def warehouse(tmp_path_factory):
+    engine = sa.create_engine(f"sqlite:///{tmp_path_factory.mktemp('warehouse') / 'warehouse.sqlite'}")
+    dims = benchmark.generate_data(engine, 2000, seed=0)
+    yield engine, dims
+    engine.dispose()
+
+
+@pytest.fixture(scope='session')
+def stand_in(warehouse):
+    return benchmark._stand_in(*warehouse)
@@ -0,0 +1,71 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+import benchmark
+from conftest import load
+
+
+@pytest.fixture(scope='module')
+def forecast_module(stand_in):
+    return load('monthly_user_forecast.py', dict(
+        stand_in, data_export=None, get_sample_sizes=None, get_user_counts=None, ceilings={}))
+
+
+@pytest.fixture(scope='module')
+def observations(warehouse):
+    """
+    Noisy logistic series for a few regions, on the quarter-end dates of the stand-in.
+    """
+    engine, dims = warehouse
+    rng = np.random.default_rng(4)
+    dates = pd.Series([benchmark.convert_quarter_to_datetime(t) for t in dims['times']])
+    t = (dates - dates.min()).dt.days.to_numpy(dtype=float)
+    views, ceilings = {}, {}
+    for i in range(4):
+        region = f"Region_{i}"
+        ceilings[region] = float(rng.uniform(0.5, 0.95))
+        k, x0 = rng.uniform(0.003, 0.01), rng.uniform(0.3, 0.7) * t.max()
+        y = ceilings[region] / (1 + np.exp(-k * (t - x0))) + rng.normal(0, 0.03, len(t))
+        views[region] = pd.DataFrame({'date': dates, 'region': region, 'date_num': t,
+                                       'service_1': np.clip(y, 0, None)})
+    return views, ceilings
+
+
+def _forecast(module, observations, fit_method):
+    views, ceilings = observations
+    regions = list(views)
+    if fit_method == 'batched':
+        x = np.stack([views[region]['date_num'].to_numpy() for region in regions])
+        y = np.stack([views[region]['service_1'].to_numpy() for region in regions])
+        params, _, _ = module['fit_logistic_batch'](x, y, np.array([ceilings[region] for region in regions]))
+    else:
+        params = [None] * len(regions)
+    return pd.concat([module['forecast_for_region'](views[region].copy(), ceilings, None, region, params=p)
+                      for region, p in zip(regions, params)])
+
+
+@pytest.mark.parametrize('fit_method', ['batched', 'curve_fit'])
+@pytest.mark.parametrize('method', ['residual', 'parametric'])
+def test_bands_contain_the_forecast_within_the_ceiling(forecast_module, observations, fit_method, method):
+    forecast = forecast_module['add_prediction_intervals'](_forecast(forecast_module, observations, fit_method),
+                                                           method=method, n_boot=300, seed=1)
+    # L is only set on the actual rows of each region
+    forecast['L'] = forecast.groupby('region')['L'].transform('first')
+    banded = forecast.dropna(subset=['p10', 'p50', 'p90'])
+    if fit_method == 'batched':
+        assert len(banded) == len(forecast)
+
+    assert (banded['p10'] <= banded['forecast'] + 1e-12).all()
+    assert (banded['forecast'] <= banded['p90'] + 1e-12).all()
+    assert (banded['p10'] >= 0).all()
+    assert (banded['p90'] <= banded['L']).all()
+
+
+def test_degenerate_fit_gets_no_bands(forecast_module, observations):
+    views, ceilings = observations
+    region = next(iter(views))
+    # A step function at the first observation, where the curve does not move with (k, x0)
+    forecast = forecast_module['forecast_for_region'](views[region].copy(), ceilings, None, region, params=(100.0, 1.0))
+    forecast = forecast_module['add_prediction_intervals'](forecast, n_boot=50)
+    assert forecast[['p10', 'p50', 'p90']].isna().all().all()
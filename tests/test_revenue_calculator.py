@@ -0,0 +1,72 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+import benchmark
+from conftest import load
+
+
+@pytest.fixture(scope='module')
+def revenue(warehouse, stand_in):
+    engine, dims = warehouse
+    master_table = benchmark._master_table(dims)
+    rng = np.random.default_rng(1)
+    basic_data = pd.DataFrame([(benchmark.convert_quarter_to_datetime(t), t, dims['region_of'][territory], territory)
+                               for t in dims['times'] for territory in dims['territories']],
+                              columns=['date', 'time', 'region', 'territory'])
+    basic_data['economy_metric'] = rng.uniform(1, 100, len(basic_data))
+    basic_data['currency'] = 'USD'
+    basic_data['exchange_rate'] = rng.uniform(0.5, 2, len(basic_data))
+    module = load('revenue_calculator.py', dict(
+        stand_in, master_table=master_table, basic_data_export=lambda: basic_data.copy()))
+    return module, basic_data, master_table
+
+
+def _wide_values(wide):
+    """
+    The metric block of a wide output, indexed by (date, territory) with (company, subcategory) columns.
+    """
+    values = wide.set_index([('date', ''), ('territory', '')])
+    values.index.names = ['date', 'territory']
+    values = values[[column for column in values.columns if column[1] != '']]
+    values.columns.names = ['company', 'subcategory']
+    return values.astype(np.float32)
+
+
+def test_long_output_round_trips_to_wide(revenue):
+    module, basic_data, master_table = revenue
+    wide = _wide_values(module['metric_calculator'](basic_data.copy(), master_table.copy()))
+    long = module['metric_calculator'](basic_data.copy(), master_table.copy(), output='long')
+
+    # long -> wide
+    pivoted = long.pivot_table(index=['date', 'territory'], columns=['company', 'subcategory'], values='value',
+                               observed=True, aggfunc='first')
+    pivoted = pivoted.reindex(index=wide.index, columns=wide.columns)
+    pd.testing.assert_frame_equal(pivoted, wide, check_names=False)
+
+    # wide -> long
+    stacked = wide.stack(['company', 'subcategory'], future_stack=True).dropna()
+    long_values = long.set_index(['date', 'territory', 'company', 'subcategory'])['value']
+    long_values.index = long_values.index.set_levels(
+        [level.astype(object) for level in long_values.index.levels[1:]], level=[1, 2, 3])
+    pd.testing.assert_series_equal(long_values.sort_index(), stacked.sort_index(), check_names=False,
+                                   check_index_type=False)
+
+
+def test_long_output_honours_valid_pairs(revenue):
+    module, basic_data, master_table = revenue
+    valid_pairs = master_table[['company', 'base_territory']].rename(columns={'base_territory': 'territory'})
+    long = module['metric_calculator'](basic_data.copy(), master_table.copy(), output='long')
+    narrowed = module['metric_calculator'](basic_data.copy(), master_table.copy(), output='long',
+                                           valid_pairs=valid_pairs)
+
+    allowed = set(map(tuple, valid_pairs.drop_duplicates().to_numpy()))
+    assert 0 < len(narrowed) < len(long)
+    assert set(zip(narrowed['company'].astype(str), narrowed['territory'].astype(str))) <= allowed
+
+    keys = ['date', 'territory', 'company', 'subcategory']
+    expected = long[[(c, t) in allowed for c, t in zip(long['company'].astype(str), long['territory'].astype(str))]]
+    merged = narrowed.astype({key: object for key in keys[1:]}).merge(
+        expected.astype({key: object for key in keys[1:]}), on=keys, suffixes=('', '_all'))
+    assert len(merged) == len(narrowed) == len(expected)
+    np.testing.assert_array_equal(merged['value'], merged['value_all'])
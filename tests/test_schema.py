@@ -0,0 +1,34 @@
+import pandas as pd
+import pytest
+
+import benchmark
+from conftest import load
+
+
+@pytest.fixture(scope='module')
+def data_export(stand_in):
+    module = load('data_export.py', dict(
+        stand_in, TableOne=benchmark.MarketFacts, TableTwo=benchmark.MarketCountries,
+        TableThree=benchmark.MarketRates))
+    return module['data_export']
+
+
+def _categorical_dtypes(data_df):
+    return {column: dtype for column, dtype in data_df.dtypes.items() if isinstance(dtype, pd.CategoricalDtype)}
+
+
+def test_aliased_columns_share_one_dtype(data_export):
+    data_df = data_export(rate_types=None)
+    assert data_df['currency'].dtype == data_df['output_currency'].dtype
+    assert isinstance(data_df['currency'].dtype, pd.CategoricalDtype)
+
+
+def test_consecutive_exports_have_identical_dtypes(data_export):
+    first = data_export(rate_types=None)
+    second = data_export(rate_types=None)
+    assert _categorical_dtypes(first)
+    assert dict(first.dtypes) == dict(second.dtypes)
+
+    combined = pd.concat([first, second], ignore_index=True)
+    for column, dtype in _categorical_dtypes(first).items():
+        assert combined[column].dtype == dtype
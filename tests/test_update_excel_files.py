@@ -0,0 +1,50 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from conftest import load
+
+
+@pytest.fixture(scope='module')
+def workbook(stand_in):
+    return load('update_excel_files.py', stand_in)
+
+
+def _float_frame(dtype):
+    rng = np.random.default_rng(0)
+    return pd.DataFrame({
+        'Territory': [f"T{i % 7}" for i in range(200)],
+        'Index': np.arange(200),
+        'Revenue': rng.uniform(0, 1e6, 200).astype(dtype),
+        'Share': rng.uniform(0, 1, 200).astype(dtype)
+    })
+
+
+@pytest.mark.parametrize('dtype', [np.float32, np.float64])
+def test_unchanged_frame_diffs_to_no_changes(workbook, tmp_path, dtype):
+    from openpyxl import Workbook, load_workbook
+
+    path = tmp_path / 'diff.xlsx'
+    df = _float_frame(dtype)
+    wb = Workbook()
+    workbook['write_sheet'](wb.active, df)
+    wb.save(path)
+
+    report = workbook['diff_sheet'](load_workbook(path).active, df, ['Territory', 'Index'])
+    assert report == {'changed_cells': 0, 'changed_rows': 0, 'added_rows': 0, 'removed_rows': 0,
+                      'rewritten': False}
+
+
+def test_changed_cells_are_reported(workbook, tmp_path):
+    from openpyxl import Workbook, load_workbook
+
+    path = tmp_path / 'diff.xlsx'
+    df = _float_frame(np.float32)
+    wb = Workbook()
+    workbook['write_sheet'](wb.active, df)
+    wb.save(path)
+
+    changed = df.copy()
+    changed.loc[[3, 50], 'Revenue'] += np.float32(1)
+    report = workbook['diff_sheet'](load_workbook(path).active, changed, ['Territory', 'Index'])
+    assert (report['changed_cells'], report['changed_rows']) == (2, 2)
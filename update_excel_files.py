@@ -2,24 +2,38 @@
 This module updates specified Excel workbooks with the latest figures from the database.
 It maintains all existing formulas and other sheets in the workbooks.
 The paths for the workbooks are defined in a central configuration file.
+
+The export and calculation modules, pandas, openpyxl and the configuration are imported on first use,
+so only the stages needed for the selected sheets are loaded.
+
+Usage:
+------
+python update_excel_files.py
+python update_excel_files.py --sheets Cost,Usage_Forecast --workbooks forecast.xlsx
+python update_excel_files.py --list
 """
 
 # Import necessary libraries
+import argparse
+import importlib
 import os
-import pandas as pd
-from openpyxl import load_workbook, Workbook
+import sys
+from functools import partial
 
-# Import required functions from other modules
-from src.utils.data_export_funcs import basics_export, get_service_usage
-from src.calculations.cost_calculator import main as calculate_cost
-from src.calculations.usage_forecast import main as usage_forecast
-from src.calculations.viewing_forecast import main as viewing_forecast
+# Pipeline runner and timing spans for the exports
+from pipeline import run_pipeline
+from instrumentation import enable_tracing, span, summary_report
 
-# Additional functions 
-from src.utils.data_export_funcs import get_device_info
+def _call_lazy(module_name, attribute, *args):
+    # Imports the module on the first call, so unused stages never load their dependencies
+    return getattr(importlib.import_module(module_name), attribute)(*args)
 
-# Import configuration information
-from src.utils.config import wb_update_paths, custom_colors
+def _lazy(module_name, attribute):
+    return partial(_call_lazy, module_name, attribute)
+
+def _config(name):
+    # Configuration information, e.g. wb_update_paths and custom_colors
+    return getattr(importlib.import_module('src.utils.config'), name)
 
 # Define columns for renaming
 basic_columns = {
@@ -48,57 +62,346 @@ service_usage_columns = {
 
 # Function to update or create sheets in each workbook
 def update_sheets(df, sheet, file_path, wb):
-    # Implementation of update_sheets function...
+    # Writes df to the sheet of the open workbook, see write_sheet
+    write_sheet(wb[sheet], df)
+
+# Extracts shared by several stages, pulled once per run
+shared_extracts = {
+    'basic_data': [_lazy('src.utils.data_export_funcs', 'basics_export'), []]
+}
+
+def _use_extract(df):
+    return df
+
+# Export function, input stages, user-friendly column names and sheet name for each sheet
+exports = {
+    'basic_info': [_use_extract, ['basic_data'], basic_columns, 'Basic_Info'],
+    'cost': [_lazy('src.calculations.cost_calculator', 'main'), [], cost_columns, 'Cost'],
+    'usage': [_lazy('src.calculations.usage_forecast', 'main'), [], usage_columns, 'Usage_Forecast'],
+    'viewing': [_lazy('src.calculations.viewing_forecast', 'main'), [], viewing_columns, 'Viewing_Forecast'],
+    'devices': [_lazy('src.utils.data_export_funcs', 'get_device_info'), [], device_columns, 'Device_Info'],
+    'service_usage': [_lazy('src.utils.data_export_funcs', 'get_service_usage'), [], service_usage_columns, 'Service_Usage']
+}
+
+def _renamed_export(export, columns, *inputs):
+    df = export(*inputs)
+    return df.rename(columns=columns)  # user-friendly column names
+
+def pipeline_stages():
+    """
+    Builds the pipeline stages of the refresh: the shared extracts plus one stage per sheet.
+
+    Returns:
+    - stages (dict): The [function, input names] of each stage, for pipeline.run_pipeline.
+    """
+    stages = dict(shared_extracts)
+    for name, (export, inputs, columns, sheet_name) in exports.items():
+        stages[name] = [partial(_renamed_export, export, columns), inputs]
+    return stages
+
+def run_exports(names, concurrent=False, workers=None):
+    """
+    Runs the exports for the given sheets and collects the failures instead of aborting.
+
+    The exports run as a pipeline, so shared extracts are pulled once and only the stages needed
+    for the given sheets run. The exports spend most of their time waiting on the database, so in
+    concurrent mode independent stages run in parallel on a thread pool.
+
+    Parameters:
+    - names (list): The keys of the exports to run.
+    - concurrent (bool): If True, independent stages run in parallel on a thread pool.
+    - workers (int): The number of threads. Defaults to one per stage.
+
+    Returns:
+    - results (dict): The renamed dataframe of each export that succeeded.
+    - failures (dict): The formatted traceback of each stage that failed.
+    """
+    stages = pipeline_stages()
+    results, failures = run_pipeline(stages, targets=names, concurrent=concurrent, workers=workers)
+    results = {name: df for name, df in results.items() if name in exports}
+
+    for name, error in failures.items():
+        label = exports[name][3] if name in exports else name
+        print(f"Stage {label} failed and will be skipped:")
+        print(error)
+    return results, failures
+
+def write_sheet(ws, df):
+    """
+    Writes a dataframe to a worksheet in one pass, header in the first row.
+
+    Only the columns the dataframe covers are overwritten, and rows left over from a longer previous
+    version are blanked in those columns only, so formulas in the other columns are preserved.
+    Empty sheets are streamed row by row with append.
+
+    Parameters:
+    - ws (openpyxl Worksheet): The worksheet to write to.
+    - df (pandas.DataFrame): The data to write.
+    """
+    # Missing values become empty cells
+    values = df.astype(object).where(df.notna(), None)
+    rows = values.itertuples(index=False, name=None)
+
+    is_empty = ws.max_row == 1 and ws.max_column == 1 and ws.cell(row=1, column=1).value is None
+    previous_rows = ws.max_row
+
+    for col, header in enumerate(df.columns, start=1):
+        ws.cell(row=1, column=col).value = header
+
+    if is_empty:
+        for row in rows:
+            ws.append(row)
+        return
+
+    # Assign .value directly, ws.cell(value=None) would leave the old value in place
+    for r, row in enumerate(rows, start=2):
+        for col, value in enumerate(row, start=1):
+            ws.cell(row=r, column=col).value = value
+    for r in range(len(df) + 2, previous_rows + 1):
+        for col in range(1, len(df.columns) + 1):
+            ws.cell(row=r, column=col).value = None
+
+def _cell_value(value):
+    """
+    Converts a pandas/numpy value to the plain Python value openpyxl reads back, so values can be compared.
+
+    openpyxl writes floats with 16 significant digits, so floats are rounded the same way. Otherwise a float32
+    value, or a float64 value that needs 17 digits, never equals the cell it was written to.
+    """
+    import pandas as pd
+    if value is None or (not isinstance(value, str) and pd.isna(value)):
+        return None
+    if isinstance(value, pd.Timestamp):
+        return value.to_pydatetime()
+    if hasattr(value, 'item'):
+        value = value.item()
+    if isinstance(value, float):
+        return float('%.16g' % value)
+    return value
+
+def diff_sheet(ws, df, key_columns):
+    """
+    Updates a worksheet in place so it matches the dataframe, touching only the cells that differ.
+
+    Rows are matched on key_columns. Matched rows keep their position and only their changed cells are written.
+    Added rows reuse the positions of removed rows first and are appended after the last row otherwise.
+    Removed rows that are not reused are blanked. If the header does not match the dataframe columns,
+    the sheet is rewritten with write_sheet instead.
 
-def main():
-    basic_info = basics_export()
-    basic_info = basic_info.rename(columns=basic_columns)  # user-friendly column names
+    Parameters:
+    - ws (openpyxl Worksheet): The worksheet to update.
+    - df (pandas.DataFrame): The new data.
+    - key_columns (list): The columns that identify a row, e.g. ['Territory', 'Date'].
 
-    cost = calculate_cost()
-    cost = cost.rename(columns=cost_columns)  # user-friendly column names
+    Returns:
+    - report (dict): The number of changed cells, changed rows, added rows and removed rows,
+      and whether the sheet had to be rewritten.
+    """
+    report = {'changed_cells': 0, 'changed_rows': 0, 'added_rows': 0, 'removed_rows': 0, 'rewritten': False}
+    columns = list(df.columns)
+    if df.duplicated(key_columns).any():
+        raise ValueError(f"The key columns {key_columns} do not identify the rows of the dataframe uniquely.")
 
-    usage = usage_forecast()
-    usage = usage.rename(columns=usage_columns)  # user-friendly column names
+    header = [cell.value for cell in ws[1][:len(columns)]] if ws.max_row >= 1 else []
+    if header != columns:
+        write_sheet(ws, df)
+        report.update(rewritten=True, added_rows=len(df))
+        return report
 
-    viewing = viewing_forecast()
-    viewing = viewing.rename(columns=viewing_columns)  # user-friendly column names
+    key_positions = [columns.index(key) for key in key_columns]
+    existing = {}
+    for r, row in enumerate(ws.iter_rows(min_row=2, max_col=len(columns), values_only=True), start=2):
+        if all(value is None for value in row):
+            continue
+        existing[tuple(_cell_value(row[i]) for i in key_positions)] = (r, row)
 
-    devices = get_device_info()
-    devices = devices.rename(columns=device_columns)  # user-friendly column names
+    new_rows = [tuple(_cell_value(value) for value in row) for row in df.itertuples(index=False, name=None)]
+    new_keys = set()
+    added = []
+    for row in new_rows:
+        key = tuple(row[i] for i in key_positions)
+        new_keys.add(key)
+        if key not in existing:
+            added.append(row)
+            continue
+        r, old_row = existing[key]
+        changed = [col for col, (old, new) in enumerate(zip(old_row, row)) if _cell_value(old) != new]
+        for col in changed:
+            ws.cell(row=r, column=col + 1).value = row[col]
+        report['changed_cells'] += len(changed)
+        report['changed_rows'] += bool(changed)
 
-    service_usage = get_service_usage()
-    service_usage = service_usage.rename(columns=service_usage_columns)  # user-friendly column names
+    free_rows = sorted(r for key, (r, _) in existing.items() if key not in new_keys)
+    report['removed_rows'] = len(free_rows)
+    report['added_rows'] = len(added)
+
+    next_row = ws.max_row + 1
+    for row in added:
+        if free_rows:
+            r = free_rows.pop(0)
+        else:
+            r, next_row = next_row, next_row + 1
+        for col, value in enumerate(row, start=1):
+            ws.cell(row=r, column=col).value = value
+    for r in free_rows:
+        for col in range(1, len(columns) + 1):
+            ws.cell(row=r, column=col).value = None
+
+    return report
+
+def update_workbook(path, sheets, diff_keys=None, tab_color=None):
+    """
+    Applies every sheet update to one workbook and saves it once.
+
+    Parameters:
+    - path (str): The path of the workbook.
+    - sheets (dict): The [dataframe, sheet name] of each sheet to update.
+    - diff_keys (dict): The key columns of the sheets to update with diff_sheet, by sheet name.
+      The other sheets are rewritten with write_sheet.
+    - tab_color (str): The hex color of the updated sheet tabs. Defaults to the fifth custom color.
+
+    Returns:
+    - updated (bool): False if the workbook does not exist.
+    """
+    from openpyxl import load_workbook
+
+    diff_keys = diff_keys or {}
+    tab_color = tab_color or _config('custom_colors')[4][1:]
+    try:
+        with span('update_excel_files.load', f"Updating workbook at {path}...", workbook=path):
+            wb = load_workbook(path)
+    except FileNotFoundError:
+        print(f"Workbook not found at {path}. Skipping...")
+        return False
+
+    for df, sheet_name in sheets.values():
+        with span('update_excel_files.write', workbook=path, sheet=sheet_name) as s:
+            s.frame_in(df)
+            if sheet_name in wb.sheetnames and sheet_name in diff_keys:
+                report = diff_sheet(wb[sheet_name], df, diff_keys[sheet_name])
+                s.set(**report)
+                if report['rewritten']:
+                    print(f"{sheet_name}: columns changed, sheet rewritten.")
+                else:
+                    print(f"{sheet_name}: {report['changed_cells']} cells changed in {report['changed_rows']} rows, "
+                          f"{report['added_rows']} rows added, {report['removed_rows']} rows removed.")
+            else:
+                if sheet_name not in wb.sheetnames:
+                    wb.create_sheet(sheet_name)
+                write_sheet(wb[sheet_name], df)
+            wb[sheet_name].sheet_properties.tabColor = tab_color
+
+    with span('update_excel_files.save', workbook=path):
+        wb.save(path)
+    return True
+
+def update_workbooks(paths, sheets, parallel=False, workers=None, diff_keys=None):
+    """
+    Updates every workbook with the same sheets, optionally in parallel processes.
+
+    Parameters:
+    - paths (list): The paths of the workbooks.
+    - sheets (dict): The [dataframe, sheet name] of each sheet to update.
+    - parallel (bool): If True, each workbook is loaded, updated and saved in its own process.
+    - workers (int): The number of processes. Defaults to the number of CPUs.
+    - diff_keys (dict): The key columns of the sheets to update with diff_sheet, by sheet name.
+
+    Returns:
+    - updated (list): Whether each workbook was updated, in the order of paths.
+    """
+    if parallel and len(paths) > 1:
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            return list(executor.map(partial(update_workbook, sheets=sheets, diff_keys=diff_keys), paths))
+    return [update_workbook(path, sheets, diff_keys=diff_keys) for path in paths]
+
+def main(concurrent=False, workers=None, parallel_workbooks=False, diff_keys=None, sheet_names=None, trace=False,
+         workbook_paths=None):
+    # trace=True records timing spans and prints a summary at the end, a path also logs them as JSON lines
+    if trace:
+        enable_tracing(trace if isinstance(trace, str) else None)
+
+    # Only run the stages needed for the selected sheets
+    names = [name for name in exports if sheet_names is None or exports[name][3] in sheet_names]
+    results, failures = run_exports(names, concurrent=concurrent, workers=workers)
 
     # Implementation for saving these dataframes to separate csv files...
 
-    sheets = {
-        'basic_info': [basic_info, 'Basic_Info'],
-        'cost': [cost, 'Cost'],
-        'usage': [usage, 'Usage_Forecast'],
-        'viewing': [viewing, 'Viewing_Forecast'],
-        'devices': [devices, 'Device_Info'],
-        'service_usage': [service_usage, 'Service_Usage']
-    }
+    sheets = {name: [df, exports[name][3]] for name, df in results.items()}
 
-    for path in wb_update_paths:
+    print("")
+    if workbook_paths is None:
+        workbook_paths = _config('wb_update_paths')
+    update_workbooks(workbook_paths, sheets, parallel=parallel_workbooks, workers=workers, diff_keys=diff_keys)
+    if failures:
+        print(f"Update complete with {len(failures)} failed stages: {', '.join(failures)}.")
+    else:
+        print("Update complete.")
+    if trace:
         print("")
+        # Spans of parallel workbook processes are only in the log file
+        summary_report(log_path=trace if isinstance(trace, str) else None)
+    return failures
+
+def _select_workbooks(selection, paths):
+    """
+    Matches each selected workbook against the configured paths by full path or file name.
+    """
+    selected = []
+    for item in selection:
+        matches = [path for path in paths if path == item or os.path.basename(path) == item]
+        if not matches:
+            raise ValueError(f"Unknown workbook '{item}'. Use --list to see the configured workbooks.")
+        selected.extend(path for path in matches if path not in selected)
+    return selected
+
+def cli(argv=None):
+    """
+    Command line entry point. Only the stages and workbooks selected on the command line are loaded and run.
+
+    Returns:
+    - exit_code (int): 1 if any stage failed, 0 otherwise.
+    """
+    sheet_choices = {sheet_name: name for name, (_, _, _, sheet_name) in exports.items()}
+
+    parser = argparse.ArgumentParser(description="Update the Excel workbooks with the latest figures from the database.")
+    parser.add_argument('--sheets', help=f"comma-separated sheets to update, default all: {','.join(sheet_choices)}")
+    parser.add_argument('--workbooks', help="comma-separated workbook paths or file names from the configuration, default all")
+    parser.add_argument('--list', action='store_true', help="list the sheets and configured workbooks and exit")
+    parser.add_argument('--concurrent', action='store_true', help="run independent exports in parallel threads")
+    parser.add_argument('--workers', type=int, help="number of threads or processes")
+    parser.add_argument('--parallel-workbooks', action='store_true', help="update each workbook in its own process")
+    parser.add_argument('--trace', nargs='?', const=True, default=False, metavar='LOG_PATH',
+                        help="record timing spans and print a summary, optionally logging them as JSON lines")
+    args = parser.parse_args(argv)
+
+    if args.list:
+        print("Sheets:")
+        for sheet_name in sheet_choices:
+            print(f"  {sheet_name}")
+        print("Workbooks:")
+        for path in _config('wb_update_paths'):
+            print(f"  {path}")
+        return 0
+
+    sheet_names = None
+    if args.sheets:
+        sheet_names = [sheet.strip() for sheet in args.sheets.split(',') if sheet.strip()]
+        unknown = [sheet for sheet in sheet_names if sheet not in sheet_choices]
+        if unknown:
+            parser.error(f"unknown sheets {', '.join(unknown)}. Choose from {', '.join(sheet_choices)}.")
+
+    workbook_paths = None
+    if args.workbooks:
         try:
-            print(f"Updating workbook at {path}...")
-            wb = load_workbook(path)
-        except FileNotFoundError:
-            print(f"Workbook not found at {path}. Skipping...")
-            pass
-        sheet_names = wb.sheetnames
-
-        for sheet in sheets:
-            if sheets[sheet][1] in sheet_names:
-                update_sheets(sheets[sheet][0], sheets[sheet][1], path, wb)
-            else:
-                wb.create_sheet(sheets[sheet][1])
-                update_sheets(sheets[sheet][0], sheets[sheet][1], path, wb)
-            wb[sheets[sheet][1]].sheet_properties.tabColor = custom_colors[4][1:]
-            wb.save(path)
-    print("Update complete.")
-
-# Test the module
-main()
+            workbook_paths = _select_workbooks([item.strip() for item in args.workbooks.split(',') if item.strip()],
+                                               _config('wb_update_paths'))
+        except ValueError as error:
+            parser.error(str(error))
+
+    failures = main(concurrent=args.concurrent, workers=args.workers, parallel_workbooks=args.parallel_workbooks,
+                    sheet_names=sheet_names, trace=args.trace, workbook_paths=workbook_paths)
+    return 1 if failures else 0
+
+if __name__ == "__main__":
+    sys.exit(cli())